@@ -22,13 +22,57 @@ How to use in Spyder:
 
 CLI:
     python make_tiff_stacks.py /path/to/folder --group-size 12 --ext jpg png tif tiff --include-incomplete
+    python make_tiff_stacks.py /path/to/folder --workers 8 --executor process
+    python make_tiff_stacks.py /path/to/folder --watch --idle-timeout 600 --detect-output /path/to/json
+    python make_tiff_stacks.py /path/to/folder --detect-output /path/to/json [--no-tiff]
+    python make_tiff_stacks.py /path/to/folder --format zarr --tile-size 512
+
+Stack formats (STACK_FORMAT / --format):
+- "tiff":     contiguous multi-page TIFF (default); uncompressed stacks can be memory-mapped.
+- "ome-tiff": tiled OME-TIFF with the same file names; tiles are decoded on demand.
+- "zarr":     one chunked Zarr store per slide (<output_subfolder>/stacks.zarr) with an
+              array per stack; needs the zarr package.
+open_stack() gives lazy access to any of them, e.g. open_stack(p)[z, y0:y1, x0:x1].
+
+Slide layout (GRID / --grid ROWS COLS):
+The k-th stack of the folder is the field at grid position (row, col), column-major
+by default (as in Edge_Pollen_Merging.py). With a grid, <output_subfolder>/slide.json
+records the grid shape, order, image size, plane count, field overlap and the
+position of every stack; with MOSAIC / --mosaic all fields are also written into one
+Zarr array <output_subfolder>/mosaic.zarr/fields indexed by (row, col, z), e.g.
+open_mosaic(folder)[row, col, z] (needs the zarr package).
+
+Pre-flight (--check / CHECK_ONLY):
+Reads only the image headers (shape, dtype) of the whole folder in parallel and
+reports inconsistent or unreadable groups, gaps in the frame numbering and an
+incomplete final group without writing anything. The header index is cached in
+<folder>/.header_index.json; normal runs reuse it to skip bad groups before decoding.
+
+Focus metrics (FOCUS_STEP / --focus-step, 0 = off):
+While a stack is in memory, the variance of the 4-neighbour Laplacian and the
+Tenengrad of every plane are computed on a view downsampled by FOCUS_STEP and
+written to <output_subfolder>/focus_metrics.csv with the best-focus plane and a
+blank-field flag per stack. Image_Viewer opens stacks at the best plane and the
+detection prescreen reuses the middle-plane value instead of decoding it again.
+
+Extended depth of field (EDF / --edf):
+Also writes a 2D all-in-focus composite of every stack to <output_subfolder>/edf/<stack>.tif,
+taking each pixel from the plane with the highest local focus (smoothed absolute
+Laplacian). It is computed in row chunks, so only a band of the stack is expanded
+to float at a time. Image_Viewer can show it instead of a single plane.
 """
 
 from __future__ import annotations
 from pathlib import Path
 from typing import List, Tuple
+from collections import deque
+from itertools import islice
+import csv
+import json
+import os
 import re
 import sys
+import time
 
 # =========================
 # ======== CONFIG =========
@@ -42,9 +86,42 @@ ZERO_PAD = 3
 INCLUDE_INCOMPLETE = True
 COMPRESSION = "none"  # "none","zlib","lzw","jpeg","jpeg2000","packbits"
 OUTPUT_EXT = ".tif"  # choose ".tif" or ".tiff"
+STACK_FORMAT = "tiff"  # "tiff", "ome-tiff" (tiled) or "zarr" (chunked store per slide)
+TILE_SIZE = 512  # tile / chunk edge in pixels for "ome-tiff" and "zarr"
+GRID = None  # (rows, cols) of the microscope grid, e.g. (49, 16); None = no slide layout
+GRID_ORDER = "column"  # "column" (column-major, as in Edge_Pollen_Merging.py) or "row"
+OVERLAP_PX = (0, 0)  # (x, y) overlap of neighbouring fields in pixels, recorded in slide.json
+MOSAIC = False  # also write all fields into one (row, col, z) Zarr mosaic (needs GRID)
+FOCUS_STEP = 4  # downsampling of the per-plane focus metrics (0 = do not compute them)
+BLANK_THRESHOLD = 2.0  # stacks whose best plane has a Laplacian variance below this are flagged blank
+# also write an extended-depth-of-field composite per stack (<output_subfolder>/edf); it is
+# computed in the worker writing the stack, about 3 s per 12 x 1824 x 2736 RGB stack
+# (2.4 s grayscale) on one core, in addition to the stack write itself
+EDF = False
+EDF_RADIUS = 2  # radius of the box filter smoothing the per-pixel focus measure
+EDF_CHUNK_ROWS = 256  # rows of the stack processed at a time for the composite
+CHECK_ONLY = False  # only run the header pre-flight and report problems
+PREFLIGHT = True  # check group headers before decoding (bad groups are reported, not decoded)
+WORKERS = 1  # stacks written in parallel (1 = serial)
+EXECUTOR = "thread"  # "thread" (codecs release the GIL) or "process"
+WATCH = False  # keep watching FOLDER and write stacks while images are acquired
+POLL_INTERVAL = 5.0  # seconds between folder scans in watch mode
+SETTLE_SECONDS = 10.0  # an image counts as complete once unchanged for this long
+IDLE_TIMEOUT = 0  # stop watching after this many seconds without new images (0 = until Ctrl+C)
+DETECT_OUTPUT = None  # run Tofsi_Detection into this folder (watch: on each new stack; else fused run)
+WRITE_TIFF = True  # fused run: also write the stack TIFFs (in the background) for archival
 # ======== CONFIG =========
 # =========================
 
+ZARR_STORE_NAME = "stacks.zarr"
+SLIDE_META_NAME = "slide.json"
+MOSAIC_STORE_NAME = "mosaic.zarr"
+HEADER_INDEX_NAME = ".header_index.json"
+HEADER_THREADS = 8
+FOCUS_METRICS_NAME = "focus_metrics.csv"
+FOCUS_COLUMNS = ["stack", "plane", "laplacian_var", "tenengrad", "best", "blank", "step"]
+EDF_SUBFOLDER = "edf"
+
 
 def _lazy_imports():
     """Import heavy deps only when needed."""
@@ -98,7 +175,7 @@ def _ensure_consistent_group(shapes: List[Tuple[int, ...]], dtypes: List[str]):
     Returns (height, width, channels or None).
     """
     # Height/Width consistent?
-    hw = {(s[-2], s[-1]) if len(s) >= 2 else None for s in shapes}  # careful: imageio loads as (H,W[,C])
+    hw = {(s[0], s[1]) if len(s) >= 2 else None for s in shapes}  # careful: imageio loads as (H,W[,C])
     if None in hw or len(hw) != 1:
         raise ValueError(f"Inconsistent image sizes in group: {shapes}")
     (H, W) = next(iter(hw))
@@ -123,91 +200,500 @@ def _ensure_consistent_group(shapes: List[Tuple[int, ...]], dtypes: List[str]):
     return H, W, C
 
 
-def write_stack(images: List[Path], out_path: Path, compression: str | None):
+def _normalize_frame(arr, C, np):
+    """Bring one frame to the stack layout: (H,W) for grayscale, (H,W,3) for color."""
+    if C is None:
+        # grayscale stack: ensure 2D (H,W)
+        if arr.ndim == 3 and arr.shape[-1] == 1:
+            arr = arr[..., 0]
+        elif arr.ndim == 3 and arr.shape[-1] in (3, 4):
+            # shouldn't happen because C would then be 3; but guard anyway
+            arr = arr[..., :3]
+            arr = arr.mean(axis=-1).astype(arr.dtype)
+    else:
+        # color stack: ensure RGB
+        if _is_grayscale(arr):
+            arr = _promote_to_rgb(arr, np)
+        if arr.shape[-1] == 4:  # RGBA -> RGB (drop alpha)
+            arr = arr[..., :3]
+    return arr
+
+
+def assemble_stack(images: List[Path]):
     """
-    Write a true Z-stack in one call with explicit axes metadata:
-      - grayscale: (Z, Y, X), metadata={"axes": "ZYX"}
-      - color:     (Z, Y, X, 3), metadata={"axes": "ZYXC"}, photometric='rgb'
+    Decode a group of frames into one (Z, Y, X) grayscale or (Z, Y, X, 3)
+    color array. The array is allocated once from the first frame and every
+    frame is decoded straight into its slice, so only one extra frame is held
+    besides the stack itself.
     """
     tifffile, iio, np = _lazy_imports()
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-
-    # Read all frames
-    frames = []
+    data = None
     shapes = []
     dtypes = []
-    for p in images:
+    for z, p in enumerate(images):
         arr = iio.imread(p)
-        frames.append(arr)
         shapes.append(arr.shape)
         dtypes.append(str(arr.dtype))
+        # Validate against the frames read so far (same rules as for the whole group)
+        H, W, C = _ensure_consistent_group(shapes, dtypes)
+        arr = _normalize_frame(arr, C, np)
+        if data is None:
+            data = np.empty((len(images),) + arr.shape, dtype=arr.dtype)
+        elif data.ndim < arr.ndim + 1:  # first color frame after grayscale ones: promote the stack
+            data = np.repeat(data[..., None], 3, axis=-1)
+        data[z] = arr
+    return data
 
-    # Validate and normalize
-    H, W, C = _ensure_consistent_group(shapes, dtypes)
-
-    norm_frames = []
-    for arr in frames:
-        if C is None:
-            # grayscale stack: ensure 2D (H,W)
-            if arr.ndim == 3 and arr.shape[-1] == 1:
-                arr = arr[..., 0]
-            elif arr.ndim == 3 and arr.shape[-1] in (3, 4):
-                # shouldn't happen because C would then be 3; but guard anyway
-                arr = iio.core.asarray(arr)  # no-op
-                arr = arr[..., :3]
-                arr = arr.mean(axis=-1).astype(arr.dtype)
-        else:
-            # color stack: ensure RGB
-            if _is_grayscale(arr):
-                arr = _promote_to_rgb(arr, np)
-            if arr.shape[-1] == 4:  # RGBA -> RGB (drop alpha)
-                arr = arr[..., :3]
-        norm_frames.append(np.ascontiguousarray(arr))
-
-    # Build (Z, Y, X[, C]) array
-    if C is None:
-        ZYX = np.stack(norm_frames, axis=0)  # (Z,H,W)
-        axes = "ZYX"
-        kwargs = dict(metadata={"axes": axes})
+
+def _open_zarr_group(path: Path, mode: str):
+    """Open (or with mode "a" create) a Zarr store; zarr is only needed for this format."""
+    try:
+        import zarr
+    except ImportError as e:
+        raise ImportError('STACK_FORMAT "zarr" needs the zarr package (pip install zarr)') from e
+    return zarr.open_group(str(path), mode=mode)
+
+
+def _save_zarr(data, out_path: Path, tile_size: int):
+    """Write a stack as array out_path.name of the Zarr store out_path.parent, chunked per plane and tile."""
+    group = _open_zarr_group(out_path.parent, "a")
+    create = getattr(group, "create_array", None) or group.create_dataset  # zarr 3 / zarr 2
+    arr = create(out_path.name, shape=data.shape, dtype=data.dtype,
+                 chunks=(1, tile_size, tile_size) + data.shape[3:], overwrite=True)
+    arr[:] = data
+    arr.attrs["axes"] = "ZYX" if data.ndim == 3 else "ZYXC"
+
+
+def save_stack(data, out_path: Path, compression: str | None, stack_format: str = "tiff",
+               tile_size: int = 512, **options):
+    """
+    Write an assembled stack in one call with explicit axes metadata:
+      - grayscale: (Z, Y, X), metadata={"axes": "ZYX"}
+      - color:     (Z, Y, X, 3), metadata={"axes": "ZYXC"}, photometric='rgb'
+    stack_format "ome-tiff" writes a tiled OME-TIFF, "zarr" an array in a Zarr
+    store (see _save_zarr; TIFF compression does not apply there).
+    Extra tifffile.imwrite options (tile, predictor, compressionargs, ...)
+    are passed through.
+    """
+    if stack_format == "zarr":
+        return _save_zarr(data, out_path, tile_size)
+    tifffile, iio, np = _lazy_imports()
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    if data.ndim == 3:
+        kwargs = dict(metadata={"axes": "ZYX"})
     else:
-        ZYXC = np.stack(norm_frames, axis=0)  # (Z,H,W,3)
-        axes = "ZYXC"
-        kwargs = dict(metadata={"axes": axes}, photometric="rgb", planarconfig="contig")
+        kwargs = dict(metadata={"axes": "ZYXC"}, photometric="rgb", planarconfig="contig")
+    if stack_format == "ome-tiff":
+        kwargs.update(ome=True, tile=(tile_size, tile_size))
 
     # Write once. Avoid imagej=True to keep axes exactly as declared.
-    data = ZYX if C is None else ZYXC
     tifffile.imwrite(
         out_path,
         data,
         compression=(compression if compression else None),
-        **kwargs
+        **kwargs,
+        **options
     )
 
 
-def run(
+def write_stack(images: List[Path], out_path: Path, compression: str | None,
+                stack_format: str = "tiff", tile_size: int = 512, mosaic=None, focus_step: int = 0,
+                edf_path: Path | None = None):
+    """
+    Assemble a group of frames and write it as one Z-stack (see save_stack).
+    mosaic = (mosaic store, row, col) also copies the stack into that field of the slide mosaic.
+    edf_path also writes the stack's extended-depth-of-field composite there.
+    The mosaic field and the EDF are written before the stack, so a stack on
+    disk means its whole group was written (what preflight and reruns assume).
+    Returns the per-plane focus_metrics() of the stack if focus_step > 0, else None.
+    """
+    data = assemble_stack(images)
+    if mosaic is not None:
+        store, row, col = mosaic
+        _open_zarr_group(store, "r+")["fields"][row, col, :len(data)] = data
+    if edf_path is not None:
+        save_edf(data, edf_path, compression)
+    save_stack(data, out_path, compression, stack_format, tile_size)
+    return focus_metrics(data, focus_step) if focus_step > 0 else None
+
+
+# ============================================================
+# FOCUS METRICS
+# ============================================================
+def focus_metrics(data, step: int = 4):
+    """
+    Per-plane focus metrics of a (Z, Y, X[, C]) stack on a view downsampled by
+    `step`, computed for all planes at once: the variance of the 4-neighbour
+    Laplacian (the statistic of the detection prescreen) and Tenengrad (mean
+    squared 3x3 Sobel gradient magnitude). Returns two arrays of length Z.
+    """
+    tifffile, iio, np = _lazy_imports()
+    g = data[:, ::step, ::step]
+    if g.ndim == 4:
+        g = g[..., :3].mean(axis=-1)
+    g = g.astype(np.float32)
+    n = len(g)
+    lap = g[:, 1:-1, :-2] + g[:, 1:-1, 2:] + g[:, :-2, 1:-1] + g[:, 2:, 1:-1] - 4 * g[:, 1:-1, 1:-1]
+    gx = (g[:, :-2, 2:] + 2 * g[:, 1:-1, 2:] + g[:, 2:, 2:]) - (g[:, :-2, :-2] + 2 * g[:, 1:-1, :-2] + g[:, 2:, :-2])
+    gy = (g[:, 2:, :-2] + 2 * g[:, 2:, 1:-1] + g[:, 2:, 2:]) - (g[:, :-2, :-2] + 2 * g[:, :-2, 1:-1] + g[:, :-2, 2:])
+    return lap.reshape(n, -1).var(axis=1), (gx * gx + gy * gy).reshape(n, -1).mean(axis=1)
+
+
+def _abs_laplacian(g):
+    """|4-neighbour Laplacian| of every plane of a (Z, Y, X) float array, edge padded."""
+    tifffile, iio, np = _lazy_imports()
+    p = np.pad(g, ((0, 0), (1, 1), (1, 1)), mode="edge")
+    lap = p[:, 1:-1, :-2] + p[:, 1:-1, 2:]
+    lap += p[:, :-2, 1:-1]
+    lap += p[:, 2:, 1:-1]
+    lap -= 4 * g
+    return np.abs(lap, out=lap)
+
+
+def _gray_float32(data):
+    """float32 grayscale (mean of the first three channels for color) of a (Z, Y, X[, C]) array."""
+    tifffile, iio, np = _lazy_imports()
+    if data.ndim == 3:
+        return data.astype(np.float32)
+    g = data[..., 0].astype(np.float32)
+    g += data[..., 1]
+    g += data[..., 2]
+    g *= np.float32(1 / 3)
+    return g
+
+
+def _box_mean(a, r: int):
+    """Mean over a (2r+1) x (2r+1) window of every plane (separable running sums, edge padded)."""
+    tifffile, iio, np = _lazy_imports()
+    if r <= 0:
+        return a
+    k = 2 * r + 1
+    p = np.pad(a, ((0, 0), (r, r), (r, r)), mode="edge")
+    for axis in (1, 2):
+        c = np.cumsum(p, axis=axis, dtype=np.float64)
+        head = (slice(None),) * axis
+        # window sums: c[i + k - 1] - c[i - 1], with c[-1] = 0 for the first window
+        p = c[head + (slice(k - 1, None),)].copy()
+        p[head + (slice(1, None),)] -= c[head + (slice(None, -k),)]
+    return np.multiply(p, 1.0 / (k * k), dtype=np.float32)
+
+
+def edf_composite(data, radius: int = 2, chunk_rows: int = 256):
+    """
+    Extended-depth-of-field composite of a (Z, Y, X[, C]) stack: every pixel is
+    taken from the plane where the box-smoothed absolute Laplacian of the
+    grayscale image is largest. Rows are processed in chunks with a halo of
+    radius + 1 rows, which gives the same result as processing the whole plane.
+    Returns (composite (Y, X[, C]), best plane per pixel (Y, X) uint8).
+    """
+    tifffile, iio, np = _lazy_imports()
+    n_rows = data.shape[1]
+    halo = radius + 1
+    composite = np.empty(data.shape[1:], dtype=data.dtype)
+    depth = np.empty(data.shape[1:3], dtype=np.uint8)
+    for r0 in range(0, n_rows, chunk_rows):
+        r1 = min(r0 + chunk_rows, n_rows)
+        a, b = max(r0 - halo, 0), min(r1 + halo, n_rows)
+        g = _gray_float32(data[:, a:b])
+        focus = _box_mean(_abs_laplacian(g), radius)[:, r0 - a:r0 - a + (r1 - r0)]
+        best = focus.argmax(axis=0)
+        depth[r0:r1] = best
+        idx = best[None, ..., None] if data.ndim == 4 else best[None]
+        composite[r0:r1] = np.take_along_axis(data[:, r0:r1], idx, axis=0)[0]
+    return composite, depth
+
+
+def save_edf(data, edf_path: Path, compression: str | None = None):
+    """Write the extended-depth-of-field composite of a stack as a single-page TIFF."""
+    tifffile, iio, np = _lazy_imports()
+    composite, _ = edf_composite(data, EDF_RADIUS, EDF_CHUNK_ROWS)
+    edf_path.parent.mkdir(parents=True, exist_ok=True)
+    kwargs = dict(photometric="rgb") if composite.ndim == 3 else {}
+    tifffile.imwrite(edf_path, composite, compression=(compression if compression else None), **kwargs)
+
+
+def _focus_rows(name: str, metrics, step: int, blank_threshold: float):
+    """focus_metrics.csv rows of one stack (one per plane)."""
+    lap, ten = metrics
+    best = int(lap.argmax())
+    blank = int(float(lap.max()) < blank_threshold)
+    return [[name, z, f"{l:.3f}", f"{t:.3f}", int(z == best), blank, step]
+            for z, (l, t) in enumerate(zip(lap, ten))]
+
+
+def write_focus_metrics(path: Path, rows, append: bool = False):
+    """Write (or append) focus metric rows; the header is written for a new file."""
+    new = not (append and path.exists())
+    with open(path, "a" if append else "w", newline="") as f:
+        writer = csv.writer(f)
+        if new:
+            writer.writerow(FOCUS_COLUMNS)
+        writer.writerows(rows)
+
+
+def read_focus_metrics(path) -> dict:
+    """
+    {stack: {"laplacian_var": [...], "tenengrad": [...], "best_plane", "blank", "step"}}
+    from a focus_metrics.csv (later rows of a stack replace earlier ones).
+    """
+    stacks = {}
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            z = int(row["plane"])
+            if z == 0:
+                stacks[row["stack"]] = {"laplacian_var": [], "tenengrad": [], "best_plane": 0,
+                                        "blank": bool(int(row["blank"])), "step": int(row["step"])}
+            entry = stacks[row["stack"]]
+            entry["laplacian_var"].append(float(row["laplacian_var"]))
+            entry["tenengrad"].append(float(row["tenengrad"]))
+            if int(row["best"]):
+                entry["best_plane"] = z
+    return stacks
+
+
+# ============================================================
+# SLIDE LAYOUT
+# ============================================================
+def grid_position(k: int, grid: Tuple[int, int], order: str = "column") -> Tuple[int, int]:
+    """(row, col) of the k-th stack (0-based) of a slide."""
+    n_rows, n_cols = grid
+    if order == "column":
+        return k % n_rows, k // n_rows
+    return k // n_cols, k % n_cols
+
+
+def _first_frame(images: List[Path]):
+    """Decode and normalize the first frame of a group (for the slide image size and dtype)."""
+    tifffile, iio, np = _lazy_imports()
+    arr = iio.imread(images[0])
+    H, W, C = _ensure_consistent_group([arr.shape], [str(arr.dtype)])
+    return _normalize_frame(arr, C, np)
+
+
+def slide_meta(names: List[str], grid, order, frame, n_planes, overlap) -> dict:
+    """Slide layout record written to slide.json and to the mosaic attributes."""
+    return {
+        "grid": {"rows": grid[0], "cols": grid[1], "order": order},
+        "image_width": int(frame.shape[1]),
+        "image_height": int(frame.shape[0]),
+        "channels": int(frame.shape[2]) if frame.ndim == 3 else 1,
+        "dtype": str(frame.dtype),
+        "n_planes": n_planes,
+        "overlap_px": {"x": overlap[0], "y": overlap[1]},
+        "stacks": {name: list(grid_position(k, grid, order)) for k, name in enumerate(names)},
+    }
+
+
+def _create_mosaic(store: Path, meta: dict, frame, tile_size: int):
+    """Create the empty (row, col, Z, Y, X[, C]) mosaic array; fields not acquired stay 0."""
+    group = _open_zarr_group(store, "a")
+    rows, cols = meta["grid"]["rows"], meta["grid"]["cols"]
+    create = getattr(group, "create_array", None) or group.create_dataset  # zarr 3 / zarr 2
+    fields = create("fields", shape=(rows, cols, meta["n_planes"]) + frame.shape, dtype=frame.dtype,
+                    chunks=(1, 1, 1, tile_size, tile_size) + frame.shape[2:], fill_value=0,
+                    overwrite=True)
+    fields.attrs.update(meta, axes="RCZYX" if frame.ndim == 2 else "RCZYXC")
+
+
+def open_mosaic(folder, output_subfolder: str = "stacks"):
+    """Open a slide mosaic for lazy (row, col, z, y, x) indexing; attrs hold the slide layout."""
+    return _open_zarr_group(Path(folder) / output_subfolder / MOSAIC_STORE_NAME, "r")["fields"]
+
+
+def list_stacks(folder) -> List[Path]:
+    """Natural-sorted stacks of a folder of TIFFs or of a Zarr stack store."""
+    folder = Path(folder)
+    if folder.suffix == ".zarr":
+        names = [p.name for p in folder.iterdir() if p.is_dir()]
+    else:
+        names = [p.name for p in folder.iterdir() if p.suffix.lower() in (".tif", ".tiff")]
+    return [folder / n for n in sorted(names, key=natural_key)]
+
+
+def open_stack(path):
+    """
+    Open a stack for lazy access, so indexing only reads the planes/regions needed:
+      - array in a Zarr store (".../stacks.zarr/stack_001"): zarr array
+      - uncompressed contiguous TIFF: numpy memmap
+      - tiled or compressed TIFF: zarr view of the TIFF pages
+        (fully decoded array if zarr is not installed)
+    """
+    path = Path(path)
+    if path.parent.suffix == ".zarr":
+        return _open_zarr_group(path.parent, "r")[path.name]
+    tifffile, iio, np = _lazy_imports()
+    try:
+        return tifffile.memmap(path, mode="r")
+    except ValueError:  # not memory-mappable
+        pass
+    try:
+        import zarr
+    except ImportError:
+        return tifffile.imread(path)
+    return zarr.open(tifffile.imread(path, aszarr=True), mode="r")
+
+
+def _group_error(images, e) -> str:
+    """One-line description of a failed group."""
+    return f"{images[0].name}..{images[-1].name}: {type(e).__name__}: {e}"
+
+
+def _write_group(job):
+    """
+    Write one stack and report the outcome instead of raising, so a bad group
+    does not abort the rest of the slide. Returns (out_path, n_slices, error, focus metrics).
+    """
+    images, out_path, compression, stack_format, tile_size, mosaic, focus_step, edf_path = job
+    try:
+        metrics = write_stack(images, out_path, compression, stack_format, tile_size, mosaic,
+                              focus_step, edf_path)
+        return out_path, len(images), None, metrics
+    except Exception as e:
+        return out_path, len(images), _group_error(images, e), None
+
+
+# ============================================================
+# HEADER PRE-FLIGHT
+# ============================================================
+def _read_header(path: Path) -> dict:
+    """Shape and dtype of an image from its header, without decoding the pixels."""
+    tifffile, iio, np = _lazy_imports()
+    props = iio.improps(path)
+    return {"shape": list(props.shape), "dtype": str(props.dtype)}
+
+
+def header_index(folder: Path, images: List[Path], n_threads: int = HEADER_THREADS) -> dict:
+    """
+    {file name: {"size", "mtime_ns", "shape", "dtype"}} for all images ("error"
+    instead of shape/dtype if the header cannot be read). Headers are read in
+    parallel and cached in <folder>/.header_index.json; only new or changed
+    files are read again.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    cache_path = folder / HEADER_INDEX_NAME
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)["files"]
+    except (FileNotFoundError, ValueError, KeyError):
+        cached = {}
+
+    index, todo = {}, []
+    for p in images:
+        st = p.stat()
+        entry = cached.get(p.name)
+        if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            index[p.name] = entry
+        else:
+            todo.append((p, st))
+
+    def read(item):
+        p, st = item
+        entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        try:
+            entry.update(_read_header(p))
+        except Exception as e:
+            entry["error"] = f"{type(e).__name__}: {e}"
+        return p.name, entry
+
+    if todo:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            index.update(pool.map(read, todo))
+        with open(cache_path.with_suffix(".tmp"), "w") as f:
+            json.dump({"files": dict(cached, **index)}, f)
+        os.replace(cache_path.with_suffix(".tmp"), cache_path)
+    return index
+
+
+def header_problems(group_list: List[List[Path]], index: dict) -> dict:
+    """{group number (0-based): problem} for groups with unreadable or inconsistent headers."""
+    problems = {}
+    for k, group in enumerate(group_list):
+        entries = [index[p.name] for p in group]
+        unreadable = [p.name for p, e in zip(group, entries) if "error" in e]
+        if unreadable:
+            problems[k] = f"unreadable image(s): {', '.join(unreadable)}"
+            continue
+        try:
+            _ensure_consistent_group([tuple(e["shape"]) for e in entries], [e["dtype"] for e in entries])
+        except ValueError as e:
+            problems[k] = str(e)
+    return problems
+
+
+def numbering_gaps(images: List[Path]) -> List[Tuple[str, str]]:
+    """(before, after) file names wherever the trailing frame number skips values."""
+    gaps = []
+    for a, b in zip(images, images[1:]):
+        na, nb = re.findall(r"\d+", a.stem), re.findall(r"\d+", b.stem)
+        same_pattern = re.sub(r"\d+", "#", a.stem) == re.sub(r"\d+", "#", b.stem)
+        if na and nb and same_pattern and int(nb[-1]) != int(na[-1]) + 1:
+            gaps.append((a.name, b.name))
+    return gaps
+
+
+def check(
     folder: Path,
     group_size: int = 12,
     extensions: List[str] | None = None,
-    output_subfolder: str = "stacks",
     prefix: str = "stack_",
     start_index: int = 1,
     zero_pad: int = 3,
     include_incomplete: bool = True,
-    compression: str = "none",
-    output_ext: str = ".tif",
 ):
-    """Core runner function (works for both Spyder and CLI)."""
+    """
+    Dry run from the image headers only: report the groups that would fail,
+    gaps in the frame numbering (which shift every later stack) and an
+    incomplete final group. Writes nothing but the header index cache.
+    Returns the list of problems.
+    """
     if extensions is None:
         extensions = ["tif", "tiff", "png", "jpg", "jpeg", "bmp"]
-
     folder = folder.expanduser().resolve()
+    if not folder.exists() or not folder.is_dir():
+        raise FileNotFoundError(f"Folder does not exist or is not a directory: {folder}")
+    images = list_images(folder, extensions)
+    group_list = list(chunks(images, group_size))
+    names = [f"{prefix}{str(idx).zfill(zero_pad)}" for idx in range(start_index, start_index + len(group_list))]
+
+    t0 = time.perf_counter()
+    index = header_index(folder, images)
+    problems = [f"{names[k]}: {msg}" for k, msg in sorted(header_problems(group_list, index).items())]
+    for before, after in numbering_gaps(images):
+        problems.append(f"missing plane(s) between {before} and {after}; later stacks are shifted")
+    if group_list and len(group_list[-1]) < group_size:
+        action = "written as is" if include_incomplete else "dropped"
+        problems.append(f"{names[-1]}: incomplete final group ({len(group_list[-1])}/{group_size} planes, {action})")
+
+    print(f"Checked {len(images)} image header(s) -> {len(group_list)} stack(s) "
+          f"in {time.perf_counter() - t0:.1f} s")
+    for problem in problems:
+        print(f"  [PROBLEM] {problem}")
+    if not problems:
+        print("No problems found.")
+    return problems
+
+
+def _print_failures(failures):
+    """Summarize the groups that could not be written."""
+    if failures:
+        print(f"{len(failures)} stack(s) failed:", file=sys.stderr)
+        for out_path, error in failures:
+            print(f"  {out_path.name}: {error}", file=sys.stderr)
+
+
+def _list_groups(folder: Path, group_size: int, extensions: List[str] | None,
+                 include_incomplete: bool) -> List[List[Path]]:
+    """Natural-sorted images of a folder split into groups (empty list if there is nothing to write)."""
+    if extensions is None:
+        extensions = ["tif", "tiff", "png", "jpg", "jpeg", "bmp"]
+
     if not folder.exists() or not folder.is_dir():
         raise FileNotFoundError(f"Folder does not exist or is not a directory: {folder}")
 
     images = list_images(folder, extensions)
     if not images:
         print("No images found matching the given extensions.", file=sys.stderr)
-        return
+        return []
 
     group_list = list(chunks(images, group_size))
     if not include_incomplete and group_list and len(group_list[-1]) < group_size:
@@ -215,6 +701,47 @@ def run(
 
     if not group_list:
         print("No complete groups to write (consider include_incomplete=True).", file=sys.stderr)
+    return group_list
+
+
+def run(
+    folder: Path,
+    group_size: int = 12,
+    extensions: List[str] | None = None,
+    output_subfolder: str = "stacks",
+    prefix: str = "stack_",
+    start_index: int = 1,
+    zero_pad: int = 3,
+    include_incomplete: bool = True,
+    compression: str = "none",
+    output_ext: str = ".tif",
+    workers: int = 1,
+    executor: str = "thread",
+    stack_format: str = "tiff",
+    tile_size: int = 512,
+    grid: Tuple[int, int] | None = None,
+    grid_order: str = "column",
+    overlap: Tuple[int, int] = (0, 0),
+    mosaic: bool = False,
+    preflight: bool = True,
+    focus_step: int = 4,
+    blank_threshold: float = 2.0,
+    edf: bool = False,
+):
+    """
+    Core runner function (works for both Spyder and CLI).
+    Stack names are assigned from natural-sort order before any work is
+    dispatched, so numbering is the same for any number of workers.
+    With a grid, slide.json (and with mosaic=True the slide mosaic) is
+    written next to the stacks. With preflight=True groups whose headers are
+    unreadable or inconsistent are reported without decoding them. With
+    focus_step > 0 the per-plane focus metrics go to focus_metrics.csv, with
+    edf=True the extended-depth-of-field composites to the edf subfolder.
+    Returns a list of (output path, error) for groups that failed.
+    """
+    folder = folder.expanduser().resolve()
+    group_list = _list_groups(folder, group_size, extensions, include_incomplete)
+    if not group_list:
         return
 
     outdir = folder / output_subfolder
@@ -228,17 +755,356 @@ def run(
     if compression == "jpeg":
         print("[WARN] JPEG typically supports 8-bit only; 16-bit images may be downcast by some viewers.")
 
+    names = [f"{prefix}{str(idx).zfill(zero_pad)}" for idx in range(start_index, start_index + len(group_list))]
+    positions = [None] * len(group_list)
+    if mosaic and grid is None:
+        raise ValueError("The slide mosaic needs the grid shape (GRID / --grid ROWS COLS).")
+    if grid is not None:
+        if len(group_list) > grid[0] * grid[1]:
+            raise ValueError(f"{len(group_list)} stacks do not fit a {grid[0]}x{grid[1]} grid.")
+        frame = _first_frame(group_list[0])
+        meta = slide_meta(names, grid, grid_order, frame, group_size, overlap)
+        with open(outdir / SLIDE_META_NAME, "w") as f:
+            json.dump(meta, f, indent=2)
+        if mosaic:
+            store = outdir / MOSAIC_STORE_NAME
+            _create_mosaic(store, meta, frame, tile_size)
+            positions = [(store, *meta["stacks"][name]) for name in names]
+
+    metrics_path = outdir / FOCUS_METRICS_NAME
+    edf_dir = outdir / EDF_SUBFOLDER
+    if stack_format == "zarr":
+        # one store per slide, one array per stack (named without extension)
+        outdir, output_ext = outdir / ZARR_STORE_NAME, ""
+        _open_zarr_group(outdir, "a")  # create the store before the workers add arrays
+
+    problems = {}
+    if preflight:
+        problems = header_problems(group_list, header_index(folder, [p for g in group_list for p in g]))
+
+    jobs = []
+    failures = []
+    for k, (g, name, position) in enumerate(zip(group_list, names, positions)):
+        out_path = outdir / f"{name}{output_ext}"
+        if k in problems:
+            error = f"{g[0].name}..{g[-1].name}: {problems[k]}"
+            print(f"[ERROR] {out_path.name}: {error}", file=sys.stderr)
+            failures.append((out_path, error))
+            continue
+        edf_path = edf_dir / f"{name}.tif" if edf else None
+        jobs.append((g, out_path, comp, stack_format, tile_size, position, focus_step, edf_path))
+
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        pool_cls = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+        pool = pool_cls(max_workers=workers)
+        outcomes = pool.map(_write_group, jobs)
+    else:
+        pool = None
+        outcomes = map(_write_group, jobs)
+
     count_written = 0
-    idx = start_index
-    for g in group_list:
-        out_name = f"{prefix}{str(idx).zfill(zero_pad)}{output_ext}"
-        out_path = outdir / out_name
-        write_stack(g, out_path, compression=comp)
-        print(f"Wrote {out_path} ({len(g)} slices)")
-        idx += 1
-        count_written += 1
+    focus_rows = []
+    try:
+        for out_path, n_slices, error, metrics in outcomes:  # in stack order
+            if error is None:
+                print(f"Wrote {out_path} ({n_slices} slices)")
+                count_written += 1
+                if metrics is not None:
+                    focus_rows += _focus_rows(out_path.stem, metrics, focus_step, blank_threshold)
+            else:
+                print(f"[ERROR] {out_path.name}: {error}", file=sys.stderr)
+                failures.append((out_path, error))
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
+    if focus_rows:
+        write_focus_metrics(metrics_path, focus_rows)
     print(f"Done. Wrote {count_written} stack(s) to: {outdir}")
+    _print_failures(failures)
+    return failures
+
+
+def _detection_handoff(output_folder):
+    """
+    Start a background thread that runs Tofsi_Detection on finished stacks.
+    Returns (queue, thread, failures); put stack paths on the queue and None
+    to stop. failures collects (stack path, error) of the failed detections.
+    """
+    import queue
+    import threading
+    import Tofsi_Detection as td
+
+    todo = queue.Queue()
+    failures = []
+
+    def worker():
+        stop = False
+        while not stop:
+            paths = [todo.get()]
+            while not todo.empty():  # take everything written in the meantime as one call
+                paths.append(todo.get())
+            if None in paths:
+                stop = True
+                paths = [p for p in paths if p is not None]
+            if not paths:
+                continue
+            try:
+                # incremental so each call appends to the folder's outputs instead of resetting them
+                td.detect([str(p) for p in paths], str(output_folder), incremental=True)
+            except Exception as e:
+                print(f"[ERROR] detection of {len(paths)} stack(s) failed: {type(e).__name__}: {e}",
+                      file=sys.stderr)
+                failures.extend((Path(p), f"detection: {type(e).__name__}: {e}") for p in paths)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    return todo, thread, failures
+
+
+def watch(
+    folder: Path,
+    group_size: int = 12,
+    extensions: List[str] | None = None,
+    output_subfolder: str = "stacks",
+    prefix: str = "stack_",
+    start_index: int = 1,
+    zero_pad: int = 3,
+    include_incomplete: bool = True,
+    compression: str = "none",
+    output_ext: str = ".tif",
+    poll_interval: float = 5.0,
+    settle_seconds: float = 10.0,
+    idle_timeout: float = 0,
+    detect_output: str | None = None,
+    focus_step: int = 4,
+    blank_threshold: float = 2.0,
+    edf: bool = False,
+):
+    """
+    Streaming mode for a folder that is still being acquired.
+    The folder is scanned every poll_interval seconds; group k holds images
+    k*group_size .. (k+1)*group_size - 1 in natural-sort order (same numbering
+    as run(), so acquisition file names must sort in acquisition order). A
+    group is written as soon as all its images exist and have kept the same
+    size and mtime for settle_seconds. Stacks are written under a temporary
+    name and renamed when complete, and existing stacks are skipped, so a
+    restarted watch continues where it stopped.
+    With idle_timeout > 0 the watch ends after that long without changes and
+    writes the last incomplete group (if include_incomplete); otherwise it runs
+    until Ctrl+C. With detect_output set, every new stack is also passed to
+    Tofsi_Detection.detect (incremental) in a background thread.
+    Returns a list of (output path, error) for groups that failed to be
+    written or detected.
+    """
+    if extensions is None:
+        extensions = ["tif", "tiff", "png", "jpg", "jpeg", "bmp"]
+
+    folder = folder.expanduser().resolve()
+    if not folder.exists() or not folder.is_dir():
+        raise FileNotFoundError(f"Folder does not exist or is not a directory: {folder}")
+
+    outdir = folder / output_subfolder
+    outdir.mkdir(exist_ok=True)
+    comp = None if compression == "none" else compression
+    handoff = _detection_handoff(detect_output) if detect_output else None
+
+    failures = []
+    count_written = 0
+
+    def emit(group, k):
+        nonlocal count_written
+        out_path = outdir / f"{prefix}{str(start_index + k).zfill(zero_pad)}{output_ext}"
+        if not out_path.exists():
+            tmp_path = out_path.with_name(f".{out_path.name}.part")
+            edf_path = outdir / EDF_SUBFOLDER / f"{out_path.stem}.tif" if edf else None
+            _, n_slices, error, metrics = _write_group((group, tmp_path, comp, "tiff", TILE_SIZE, None,
+                                                        focus_step, edf_path))
+            if error is not None:
+                print(f"[ERROR] {out_path.name}: {error}", file=sys.stderr)
+                failures.append((out_path, error))
+                return
+            os.replace(tmp_path, out_path)
+            if metrics is not None:
+                write_focus_metrics(outdir / FOCUS_METRICS_NAME,
+                                    _focus_rows(out_path.stem, metrics, focus_step, blank_threshold),
+                                    append=True)
+            print(f"Wrote {out_path} ({n_slices} slices)")
+            count_written += 1
+        if handoff is not None:
+            handoff[0].put(out_path)
+
+    print(f"Watching {folder} (Ctrl+C to stop)")
+    next_group = 0
+    previous = {}  # image -> (size, mtime_ns) at the previous scan
+    images = []
+    last_change = time.monotonic()
+    finished = False
+    try:
+        while True:
+            current = {}
+            for p in list_images(folder, extensions):
+                try:
+                    st = p.stat()
+                except FileNotFoundError:  # renamed/removed between listing and stat
+                    continue
+                current[p] = (st.st_size, st.st_mtime_ns)
+            if current != previous:
+                last_change = time.monotonic()
+            now = time.time()
+            stable = {p for p, sig in current.items()
+                      if previous.get(p) == sig and now - sig[1] / 1e9 >= settle_seconds}
+            previous = current
+            images = sorted(current, key=lambda p: natural_key(p.name))
+
+            while (next_group + 1) * group_size <= len(images):
+                group = images[next_group * group_size:(next_group + 1) * group_size]
+                if not all(p in stable for p in group):
+                    break
+                emit(group, next_group)
+                next_group += 1
+
+            if idle_timeout and time.monotonic() - last_change >= idle_timeout:
+                finished = True
+                break
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("\nWatch stopped.")
+
+    # Acquisition is over: write the last partial group as run() would
+    rest = images[next_group * group_size:]
+    if finished and rest and include_incomplete:
+        emit(rest, next_group)
+
+    if handoff is not None:
+        print("Waiting for detection of the remaining stacks...")
+        handoff[0].put(None)
+        handoff[1].join()
+        failures.extend(handoff[2])
+
+    print(f"Done. Wrote {count_written} stack(s) to: {outdir}")
+    _print_failures(failures)
+    return failures
+
+
+def _timed_assemble(images: List[Path], focus_step: int = 0):
+    """Assemble a group and return it with the seconds it took and its focus metrics (if focus_step > 0)."""
+    t0 = time.perf_counter()
+    data = assemble_stack(images)
+    seconds = time.perf_counter() - t0
+    return data, seconds, (focus_metrics(data, focus_step) if focus_step > 0 else None)
+
+
+def _save_complete(save, data, out_path: Path, *args):
+    """
+    save(data, path, *args) under a temporary name, renamed to out_path when
+    complete, so a crash or a reader never sees a half-written file there.
+    """
+    tmp_path = out_path.with_name(f".{out_path.name}.part")
+    save(data, tmp_path, *args)
+    os.replace(tmp_path, out_path)
+
+
+def run_fused(
+    folder: Path,
+    detect_output: str,
+    group_size: int = 12,
+    extensions: List[str] | None = None,
+    output_subfolder: str = "stacks",
+    prefix: str = "stack_",
+    start_index: int = 1,
+    zero_pad: int = 3,
+    include_incomplete: bool = True,
+    compression: str = "none",
+    output_ext: str = ".tif",
+    workers: int = 1,
+    write_tiff: bool = True,
+    focus_step: int = 4,
+    blank_threshold: float = 2.0,
+    edf: bool = False,
+):
+    """
+    Fused stack creation and detection: each group is assembled in memory
+    (in `workers` threads ahead of the model) and handed to
+    Tofsi_Detection.detect_arrays, so the stack is never decoded back from
+    disk. The stack TIFF is written in a background thread for archival, or
+    not at all with write_tiff=False; like the EDF it is written under a
+    temporary name and renamed when complete. Stack and JSON names are the
+    same as for run() followed by Tofsi_Detection.detect() on the stacks
+    folder. The model must accept decoded arrays (otherwise detection stops
+    on the first stack with a TypeError; use run() and detect() instead).
+    Returns a list of (output path, error) for groups that failed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import Tofsi_Detection as td
+
+    folder = folder.expanduser().resolve()
+    group_list = _list_groups(folder, group_size, extensions, include_incomplete)
+    if not group_list:
+        return
+
+    outdir = folder / output_subfolder
+    comp = None if compression == "none" else compression
+    jobs = [(g, outdir / f"{prefix}{str(idx).zfill(zero_pad)}{output_ext}")
+            for idx, g in enumerate(group_list, start=start_index)]
+    detect_jobs = [(str(out_path), os.path.join(detect_output, out_path.stem + ".json"))
+                   for _, out_path in jobs]
+
+    failures = []
+    focus_rows = []
+    pending = deque()  # (out_path, future) of TIFF writes still running
+    assembler = ThreadPoolExecutor(max_workers=max(1, workers))
+    writer = ThreadPoolExecutor(max_workers=1)
+
+    def finish_write(out_path, future):
+        error = future.exception()
+        if error is not None:
+            failures.append((out_path, f"writing: {type(error).__name__}: {error}"))
+
+    def stacks():
+        upcoming = iter(jobs)
+        ahead = deque((g, p, assembler.submit(_timed_assemble, g, focus_step))
+                      for g, p in islice(upcoming, max(1, workers)))
+        while ahead:
+            group, out_path, future = ahead.popleft()
+            nxt = next(upcoming, None)
+            if nxt is not None:
+                ahead.append((*nxt, assembler.submit(_timed_assemble, nxt[0], focus_step)))
+            try:
+                data, seconds, metrics = future.result()
+            except Exception as e:
+                failures.append((out_path, _group_error(group, e)))
+                continue
+            if metrics is not None:
+                focus_rows.extend(_focus_rows(out_path.stem, metrics, focus_step, blank_threshold))
+            if edf:
+                edf_path = outdir / EDF_SUBFOLDER / f"{out_path.stem}.tif"
+                pending.append((edf_path, writer.submit(_save_complete, save_edf, data, edf_path, comp)))
+            if write_tiff:
+                pending.append((out_path, writer.submit(_save_complete, save_stack, data, out_path, comp)))
+            while len(pending) > 2:  # bound the stacks held in memory for writing (TIFF and EDF)
+                finish_write(*pending.popleft())
+            yield str(out_path), data, seconds
+
+    try:
+        td.detect_arrays(detect_jobs, stacks(), detect_output)
+        while pending:
+            finish_write(*pending.popleft())
+    finally:
+        assembler.shutdown()
+        writer.shutdown()
+    if focus_rows:
+        outdir.mkdir(parents=True, exist_ok=True)
+        write_focus_metrics(outdir / FOCUS_METRICS_NAME, focus_rows)
+
+    n_ok = len(jobs) - len(failures)
+    if write_tiff:
+        print(f"Done. Wrote {n_ok} stack(s) to: {outdir}")
+    else:
+        print(f"Done. Detected {n_ok} stack(s) without writing TIFFs.")
+    _print_failures(failures)
+    return failures
 
 
 def _parse_args(argv: list[str]):
@@ -263,6 +1129,46 @@ def _parse_args(argv: list[str]):
                         help="TIFF compression (default: none). Note: lossy options may change pixel values.")
     parser.add_argument("--output-ext", choices=[".tif",".tiff"], default=".tif",
                         help="File extension for stacks (default: .tif).")
+    parser.add_argument("--format", dest="stack_format", choices=["tiff", "ome-tiff", "zarr"], default="tiff",
+                        help="Stack format: contiguous TIFF (default), tiled OME-TIFF or a chunked Zarr store.")
+    parser.add_argument("--tile-size", type=int, default=512,
+                        help="Tile / chunk size in pixels for ome-tiff and zarr (default: 512).")
+    parser.add_argument("--grid", nargs=2, type=int, metavar=("ROWS", "COLS"), default=None,
+                        help="Microscope grid of the slide; writes slide.json with each stack's position.")
+    parser.add_argument("--grid-order", choices=["column", "row"], default="column",
+                        help="Order in which the stacks fill the grid (default: column-major).")
+    parser.add_argument("--overlap", nargs=2, type=int, metavar=("X", "Y"), default=(0, 0),
+                        help="Overlap of neighbouring fields in pixels, recorded in slide.json.")
+    parser.add_argument("--mosaic", action="store_true",
+                        help="Also write all fields into one (row, col, z) Zarr mosaic (needs --grid).")
+    parser.add_argument("--focus-step", type=int, default=4,
+                        help="Downsampling of the per-plane focus metrics in focus_metrics.csv (0 = off, default: 4).")
+    parser.add_argument("--blank-threshold", type=float, default=2.0,
+                        help="Laplacian variance below which a stack is flagged blank (default: 2.0).")
+    parser.add_argument("--edf", action="store_true",
+                        help="Also write an extended-depth-of-field composite per stack (edf subfolder).")
+    parser.add_argument("--check", action="store_true",
+                        help="Only check the image headers and report problems (dry run).")
+    parser.add_argument("--no-preflight", action="store_true",
+                        help="Do not check group headers before decoding.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of stacks written in parallel (default: 1).")
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread",
+                        help="Parallel execution with threads or processes (default: thread).")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep watching the folder and write stacks while images arrive.")
+    parser.add_argument("--poll-interval", type=float, default=5.0,
+                        help="Watch mode: seconds between folder scans (default: 5).")
+    parser.add_argument("--settle-seconds", type=float, default=10.0,
+                        help="Watch mode: seconds an image must stay unchanged (default: 10).")
+    parser.add_argument("--idle-timeout", type=float, default=0,
+                        help="Watch mode: stop after this many idle seconds (default: 0 = until Ctrl+C).")
+    parser.add_argument("--detect-output", default=None,
+                        help="Run TOFSI detection into this folder: on each new stack in watch mode, "
+                             "otherwise on the stacks assembled in memory (fused run; the model "
+                             "must accept decoded arrays).")
+    parser.add_argument("--no-tiff", action="store_true",
+                        help="Fused run: only detect, do not write the stack TIFFs.")
     args = parser.parse_args(argv)
     return args
 
@@ -272,7 +1178,7 @@ if __name__ == "__main__":
     # If not -> Spyder mode using CONFIG above.
     if len(sys.argv) > 1:
         a = _parse_args(sys.argv[1:])
-        run(
+        common = dict(
             folder=Path(a.folder),
             group_size=a.group_size,
             extensions=a.ext,
@@ -283,10 +1189,28 @@ if __name__ == "__main__":
             include_incomplete=(not a.drop_incomplete),
             compression=a.compression,
             output_ext=a.output_ext,
+            focus_step=a.focus_step,
+            blank_threshold=a.blank_threshold,
+            edf=a.edf,
         )
+        if a.check:
+            failures = check(common["folder"], a.group_size, a.ext, a.prefix, a.start_index, a.zero_pad,
+                             common["include_incomplete"])
+        elif a.watch:
+            failures = watch(**common, poll_interval=a.poll_interval, settle_seconds=a.settle_seconds,
+                             idle_timeout=a.idle_timeout, detect_output=a.detect_output)
+        elif a.detect_output:
+            failures = run_fused(**common, detect_output=a.detect_output, workers=a.workers,
+                                 write_tiff=not a.no_tiff)
+        else:
+            failures = run(**common, workers=a.workers, executor=a.executor,
+                           stack_format=a.stack_format, tile_size=a.tile_size, grid=a.grid,
+                           grid_order=a.grid_order, overlap=tuple(a.overlap), mosaic=a.mosaic,
+                           preflight=not a.no_preflight)
+        sys.exit(1 if failures else 0)
     else:
         # Spyder mode with CONFIG
-        run(
+        common = dict(
             folder=Path(FOLDER),
             group_size=GROUP_SIZE,
             extensions=EXTENSIONS,
@@ -297,4 +1221,19 @@ if __name__ == "__main__":
             include_incomplete=INCLUDE_INCOMPLETE,
             compression=COMPRESSION,
             output_ext=OUTPUT_EXT,
+            focus_step=FOCUS_STEP,
+            blank_threshold=BLANK_THRESHOLD,
+            edf=EDF,
         )
+        if CHECK_ONLY:
+            check(Path(FOLDER), GROUP_SIZE, EXTENSIONS, OUTPUT_PREFIX, START_INDEX, ZERO_PAD,
+                  INCLUDE_INCOMPLETE)
+        elif WATCH:
+            watch(**common, poll_interval=POLL_INTERVAL, settle_seconds=SETTLE_SECONDS,
+                  idle_timeout=IDLE_TIMEOUT, detect_output=DETECT_OUTPUT)
+        elif DETECT_OUTPUT:
+            run_fused(**common, detect_output=DETECT_OUTPUT, workers=WORKERS, write_tiff=WRITE_TIFF)
+        else:
+            run(**common, workers=WORKERS, executor=EXECUTOR,
+                stack_format=STACK_FORMAT, tile_size=TILE_SIZE, grid=GRID,
+                grid_order=GRID_ORDER, overlap=OVERLAP_PX, mosaic=MOSAIC, preflight=PREFLIGHT)
@@ -0,0 +1,133 @@
+"""
+Columnar detection table shared by the JSON post-processing scripts.
+One NumPy array per field (stack id, x1/y1/x2/y2, label code, confidence)
+instead of a dict per box, plus vectorized box kernels (overlap along an
+axis, IoU, edge proximity) and an equal-key join, so whole-slide merging
+and evaluation run as array operations instead of Python loops over pairs.
+
+Boxes are (N, 4) float arrays in LabelMe rectangle order: x1, y1, x2, y2.
+"""
+
+import numpy as np
+
+SIDES = ("top", "bottom", "left", "right")  # column order of near_edge()
+
+# ============================================================
+# TABLE
+# ============================================================
+class DetectionTable:
+    """Detections as parallel arrays; label holds codes into labels."""
+
+    def __init__(self, stack, boxes, label, confidence, labels, raw=None):
+        self.stack = np.asarray(stack, dtype=np.int64)
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.label = np.asarray(label, dtype=np.int64)
+        self.confidence = np.asarray(confidence, dtype=np.float64)
+        self.labels = list(labels)
+        self.raw = raw  # optional list of the source shape dicts, row-aligned
+
+    @classmethod
+    def from_shapes(cls, items):
+        """Build a table from (stack id, LabelMe shape dict) pairs, keeping their order."""
+        items = list(items)
+        names = [shape["label"] for _, shape in items]
+        labels, codes = np.unique(np.asarray(names, dtype=object), return_inverse=True) if names else ([], [])
+        return cls(
+            stack=[stack for stack, _ in items],
+            boxes=[[shape["points"][0][0], shape["points"][0][1],
+                    shape["points"][1][0], shape["points"][1][1]] for _, shape in items],
+            label=codes,
+            confidence=[shape.get("confidence", 0.0) for _, shape in items],
+            labels=[str(l) for l in labels],
+            raw=[shape for _, shape in items],
+        )
+
+    def __len__(self):
+        return len(self.stack)
+
+    @property
+    def x1(self):
+        return self.boxes[:, 0]
+
+    @property
+    def y1(self):
+        return self.boxes[:, 1]
+
+    @property
+    def x2(self):
+        return self.boxes[:, 2]
+
+    @property
+    def y2(self):
+        return self.boxes[:, 3]
+
+    def label_name(self, i):
+        return self.labels[self.label[i]]
+
+    def take(self, index):
+        """Sub-table of the given rows (index array or boolean mask)."""
+        index = np.flatnonzero(index) if np.asarray(index).dtype == bool else np.asarray(index)
+        raw = [self.raw[i] for i in index] if self.raw is not None else None
+        return DetectionTable(self.stack[index], self.boxes[index], self.label[index],
+                              self.confidence[index], self.labels, raw)
+
+# ============================================================
+# BOX KERNELS
+# ============================================================
+def overlap_1d(a1, a2, b1, b2):
+    """Elementwise length of the overlap of [a1, a2] and [b1, b2] (0 if disjoint)."""
+    return np.maximum(0.0, np.minimum(a2, b2) - np.maximum(a1, b1))
+
+def overlap_fraction(a, b, axis):
+    """
+    Elementwise overlap of box rows a[k], b[k] along axis ("x" or "y"),
+    relative to the shorter of the two extents (0 where that extent is <= 0).
+    """
+    lo = 0 if axis == "x" else 1
+    overlap = overlap_1d(a[:, lo], a[:, lo + 2], b[:, lo], b[:, lo + 2])
+    denom = np.minimum(a[:, lo + 2] - a[:, lo], b[:, lo + 2] - b[:, lo])
+    return np.divide(overlap, denom, out=np.zeros_like(overlap), where=denom > 0)
+
+def _area(boxes):
+    return (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+def iou(a, b):
+    """Elementwise IoU of box rows a[k], b[k]."""
+    inter = (overlap_1d(a[:, 0], a[:, 2], b[:, 0], b[:, 2]) *
+             overlap_1d(a[:, 1], a[:, 3], b[:, 1], b[:, 3]))
+    return inter / np.maximum(_area(a) + _area(b) - inter, 1e-9)
+
+def iou_matrix(a, b):
+    """(len(a), len(b)) IoU of every box in a against every box in b."""
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 4)
+    inter = (overlap_1d(a[:, None, 0], a[:, None, 2], b[None, :, 0], b[None, :, 2]) *
+             overlap_1d(a[:, None, 1], a[:, None, 3], b[None, :, 1], b[None, :, 3]))
+    return inter / np.maximum(_area(a)[:, None] + _area(b)[None, :] - inter, 1e-9)
+
+def near_edge(boxes, width, height, tol):
+    """(N, 4) bool: box within tol pixels of the top, bottom, left, right image border (SIDES order)."""
+    return np.stack([
+        boxes[:, 1] <= tol,
+        boxes[:, 3] >= height - tol,
+        boxes[:, 0] <= tol,
+        boxes[:, 2] >= width - tol,
+    ], axis=1)
+
+# ============================================================
+# JOIN
+# ============================================================
+def equal_key_pairs(keys_a, keys_b):
+    """
+    All (ia, ib) index pairs with keys_a[ia] == keys_b[ib], ordered by ia and
+    then ib.
+    """
+    keys_a = np.asarray(keys_a)
+    keys_b = np.asarray(keys_b)
+    order = np.argsort(keys_b, kind="stable")
+    sorted_b = keys_b[order]
+    lo = np.searchsorted(sorted_b, keys_a, side="left")
+    counts = np.searchsorted(sorted_b, keys_a, side="right") - lo
+    ia = np.repeat(np.arange(len(keys_a)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return ia, order[np.repeat(lo, counts) + offsets]
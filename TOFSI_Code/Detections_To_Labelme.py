@@ -0,0 +1,71 @@
+"""
+Convert a compact detections.jsonl (Tofsi_Detection.py with output_format =
+"jsonl") back to one LabelMe JSON per stack for the viewer and Pollenlabeler.
+The JSONs are byte-identical to the ones the detector writes in "labelme" mode.
+If a stack occurs more than once (incremental reruns), its last record wins.
+
+CLI:
+    python Detections_To_Labelme.py /path/to/detections.jsonl [/path/to/json_output]
+A folder containing detections.jsonl may be given instead of the file; the
+output defaults to the folder of the compact file.
+"""
+
+# =========================
+# ======== CONFIG =========
+COMPACT_FILE = r"YOUR_DETECTIONS_JSONL"
+OUTPUT_FOLDER = r"LABELME_JSON_OUTPUT"
+# ======== CONFIG =========
+# =========================
+
+import json
+import os
+import sys
+
+import numpy as np
+
+from Tofsi_Detection import COMPACT_NAME, result_to_json
+
+
+def read_compact(path):
+    """Read a compact file into {stack name: result dict} in file order."""
+    results = {}
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            boxes = np.asarray(record["boxes"]).reshape(-1, 4)
+            if len(boxes):
+                cls_scores = np.asarray(record["cls_scores"]).reshape(len(boxes), -1)
+            else:
+                cls_scores = np.zeros((0, 1))
+            results[record["stack"]] = {
+                "boxes": boxes,
+                "labels": record["labels"],
+                "cls_scores": cls_scores,
+            }
+    return results
+
+
+def convert(compact_path, output_folder=None):
+    """Write <stack>.json for every stack in a compact file; returns the count."""
+    if os.path.isdir(compact_path):
+        compact_path = os.path.join(compact_path, COMPACT_NAME)
+    output_folder = output_folder or os.path.dirname(os.path.abspath(compact_path))
+    os.makedirs(output_folder, exist_ok=True)
+
+    results = read_compact(compact_path)
+    for stack, result in results.items():
+        with open(os.path.join(output_folder, stack + ".json"), "w") as f:
+            f.write(result_to_json(result))
+    return len(results)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        src = sys.argv[1]
+        dst = sys.argv[2] if len(sys.argv) > 2 else None
+    else:
+        src, dst = COMPACT_FILE, OUTPUT_FOLDER
+    n = convert(src, dst)
+    print(f"Wrote {n} LabelMe JSON file(s).")
@@ -4,13 +4,37 @@ Uses both boundary box size and confidence score to determine which pollen to de
 Assumes stacks are in order, e.g. image stack 1 relates to grid position 0,0 (row 0, column 0).
 If the grid is incorrect, it will only detect vertical edge duplicates, not horizontal (if stacks are placed in order)
 
+Batch mode (BATCH = True) merges every slide under JSON_ROOT (the output_dir layout of
+Tofsi_Detection.extract_pollen_stacks: one JSON folder per slide) in parallel processes,
+writes each slide to OUT_ROOT/<slide> and prints one combined report (plus REPORT_CSV).
+Per-slide grid geometry comes from SLIDE_GEOMETRY, else from the slide.json sidecar of
+Create_multitif_stacks.py (in the JSON folder or STACK_ROOT/<slide>/<slide>_stacks),
+else from the values below.
+
+Image check (VERIFY_IMAGES = True): before the greedy step every candidate pair is
+compared on the middle plane of the two stacks. The strips next to the shared edge
+(the stage overlap, or STRIP_PX mirrored across the seam without overlap) are
+cropped to the boxes and must correlate (normalized cross-correlation >= MIN_NCC);
+pairs that do not are kept as separate grains. Strips that are flat or whose stack
+is missing are not judged. Stacks are memory-mapped where possible and only the
+needed edge bands are kept, one read per stack.
+
 Generated using AI Prompts
 """
 
+import csv
 import json
 import glob
 import os
+import math
+import shutil
 from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from Create_multitif_stacks import list_stacks, open_stack
+from Detection_Table import SIDES, DetectionTable, equal_key_pairs, near_edge, overlap_fraction
 
 # ============================================================
 # CONFIG
@@ -27,171 +51,551 @@ IMG_HEIGHT = 1824 #In pixels
 EDGE_TOL     = 25
 OVERLAP_FRAC = 0.30   # conservative, science-first
 
-os.makedirs(OUT_DIR, exist_ok=True)
+WRITE_THREADS = 8     # threads writing the merged JSONs
+# Hard-link unchanged JSONs into OUT_DIR instead of copying them. The link shares
+# the detector's original file: Collapse_and_Remove_Classes.py and
+# Capitzalize_for_Tofsi.py rewrite JSONs in place, so running them on the merged
+# folder would silently edit the original detections too. Leave False unless
+# nothing edits the merged folder in place.
+LINK_UNCHANGED = False
+
+# --- batch mode (several slides) ---
+BATCH          = False
+JSON_ROOT      = r"YOUR_JSON_ROOT"    # one JSON folder per slide (extract_pollen_stacks output_dir)
+STACK_ROOT     = None                 # extract_pollen_stacks root_dir, searched for slide.json
+OUT_ROOT       = r"MERGED_JSON_ROOT"
+SLIDE_GEOMETRY = {}                   # e.g. {"slide_A": {"rows": 40, "cols": 12}}; keys rows, cols, order, width, height
+N_PROCESSES    = 4                    # slides merged in parallel
+REPORT_CSV     = "merge_report.csv"   # every merge of the batch, written to OUT_ROOT
+
+SLIDE_META_NAME = "slide.json"        # sidecar written by Create_multitif_stacks.py
+
+# --- optional image check of candidate pairs ---
+VERIFY_IMAGES = False
+STACK_DIR     = r"YOUR_STACK_FOLDER"  # stacks of JSON_DIR (TIFFs or stacks.zarr); batch: STACK_ROOT/<slide>/<slide>_stacks
+SEAM_OVERLAP  = (0, 0)                # stage overlap (x, y) in px; batch mode takes it from slide.json
+STRIP_PX      = 3                     # rows/columns compared on each side of the seam when there is no overlap
+MIN_NCC       = 0.3                   # pairs whose strips correlate less are not merged
 
 # ============================================================
-# GRID HELPERS (column-major)
+# GRID HELPERS (column-major by default)
 # ============================================================
-def stack_to_grid(stack_id):
+# A geometry is a dict with rows, cols, order ("column" or "row"), width and
+# height of the images and optionally positions {stack id: (row, col)} with
+# its inverse stack_at, taken from slide.json. None means the CONFIG values.
+def default_geometry():
+    return {"rows": N_ROWS, "cols": N_COLS, "order": "column",
+            "width": IMG_WIDTH, "height": IMG_HEIGHT, "overlap": SEAM_OVERLAP, "positions": None}
+
+def stack_to_grid(stack_id, geometry=None):
+    g = geometry or default_geometry()
+    if g.get("positions"):
+        return g["positions"].get(stack_id, (None, None))
     idx = stack_id - 1
-    return idx % N_ROWS, idx // N_ROWS  # row, col
-
-def grid_to_stack(r, c):
-    return c * N_ROWS + r + 1
-
-def neighbors(stack_id):
-    r, c = stack_to_grid(stack_id)
+    if g["order"] == "row":
+        return idx // g["cols"], idx % g["cols"]
+    return idx % g["rows"], idx // g["rows"]  # row, col
+
+def grid_to_stack(r, c, geometry=None):
+    g = geometry or default_geometry()
+    if g.get("positions"):
+        return g["stack_at"].get((r, c))  # None where no stack was acquired
+    if g["order"] == "row":
+        return r * g["cols"] + c + 1
+    return c * g["rows"] + r + 1
+
+def neighbors(stack_id, geometry=None):
+    g = geometry or default_geometry()
+    r, c = stack_to_grid(stack_id, g)
+    if r is None:  # stack not in the slide layout
+        return dict.fromkeys(SIDES)
     return {
-        "top":    grid_to_stack(r-1, c) if r > 0 else None,
-        "bottom": grid_to_stack(r+1, c) if r < N_ROWS-1 else None,
-        "left":   grid_to_stack(r, c-1) if c > 0 else None,
-        "right":  grid_to_stack(r, c+1) if c < N_COLS-1 else None,
+        "top":    grid_to_stack(r-1, c, g) if r > 0 else None,
+        "bottom": grid_to_stack(r+1, c, g) if r < g["rows"]-1 else None,
+        "left":   grid_to_stack(r, c-1, g) if c > 0 else None,
+        "right":  grid_to_stack(r, c+1, g) if c < g["cols"]-1 else None,
     }
 
-# ============================================================
-# BOX HELPERS
-# ============================================================
-def overlap_1d(a1, a2, b1, b2):
-    return max(0, min(a2, b2) - max(a1, b1))
-
-def overlap_fraction(b1, b2, axis):
-    if axis == "x":
-        overlap = overlap_1d(b1[0], b1[2], b2[0], b2[2])
-        denom   = min(b1[2]-b1[0], b2[2]-b2[0])
-    else:
-        overlap = overlap_1d(b1[1], b1[3], b2[1], b2[3])
-        denom   = min(b1[3]-b1[1], b2[3]-b2[1])
-    return overlap / denom if denom > 0 else 0
+def neighbor_stacks(stacks, side, geometry=None):
+    """neighbors() for an array of stack ids: (neighbour stack id, mask of stacks that have one)."""
+    ids, inverse = np.unique(stacks, return_inverse=True)
+    found = [neighbors(int(s), geometry)[side] for s in ids]
+    nb  = np.array([0 if n is None else n for n in found], dtype=np.int64)
+    has = np.array([n is not None for n in found], dtype=bool)
+    return nb[inverse], has[inverse]
 
-def near_edge(b):
-    return {
-        "top":    b[1] <= EDGE_TOL,
-        "bottom": b[3] >= IMG_HEIGHT - EDGE_TOL,
-        "left":   b[0] <= EDGE_TOL,
-        "right":  b[2] >= IMG_WIDTH - EDGE_TOL,
-    }
+OPPOSITE = {"top": "bottom", "bottom": "top", "left": "right", "right": "left"}
 
 # ============================================================
 # LOAD JSONS
 # ============================================================
-detections = []
-by_stack   = defaultdict(list)
-
-json_files = sorted(glob.glob(os.path.join(JSON_DIR, "*.json")))
-print(f"JSON files found: {len(json_files)}")
-
-for path in json_files:
-    stack_id = int(os.path.basename(path).split("_")[1].split(".")[0])
-    with open(path) as f:
-        data = json.load(f)
-
-    for obj in data.get("shapes", []):
-        det = {
-            "stack": stack_id,
-            "bbox": [
-                float(obj["points"][0][0]),
-                float(obj["points"][0][1]),
-                float(obj["points"][1][0]),
-                float(obj["points"][1][1]),
-            ],
-            "label": obj["label"],
-            "confidence": obj.get("confidence", 0.0),
-            "raw": obj
-        }
-        detections.append(det)
-        by_stack[stack_id].append(det)
-
-print(f"Loaded {len(detections)} raw detections")
+def stack_id_of(path):
+    return int(os.path.basename(path).split("_")[1].split(".")[0])
+
+def stack_json_files(json_dir):
+    """Sorted (path, stack id) of the stack JSONs; sidecars such as detection_manifest.json are skipped."""
+    found = []
+    for path in sorted(glob.glob(os.path.join(json_dir, "*.json"))):
+        try:
+            found.append((path, stack_id_of(path)))
+        except (IndexError, ValueError):
+            continue
+    return found
+
+def load_detections(json_dir, verbose=True):
+    """
+    All detections of a folder in file and shape order. Each JSON is parsed
+    once; returns (docs, DetectionTable) with docs = [(path, stack id, parsed JSON)]
+    kept for saving.
+    """
+    items = []
+    docs  = []
+    json_files = stack_json_files(json_dir)
+    if verbose:
+        print(f"JSON files found: {len(json_files)}")
+
+    for path, stack_id in json_files:
+        with open(path) as f:
+            data = json.load(f)
+        docs.append((path, stack_id, data))
+        items.extend((stack_id, obj) for obj in data.get("shapes", []))
+
+    table = DetectionTable.from_shapes(items)
+    if verbose:
+        print(f"Loaded {len(table)} raw detections")
+    return docs, table
 
 # ============================================================
 # MERGE LOGIC (FINAL, SCIENTIFIC)
 # ============================================================
-kept        = set(id(d) for d in detections)
-removed_log = []
-
-for det in detections:
-    for side, nb in neighbors(det["stack"]).items():
-        if nb is None:
+def candidate_pairs(table, geometry=None):
+    """
+    Every duplicate pair (i, j) as two arrays: j in the neighbouring stack on
+    side s of i, same label, i near edge s and j near the opposite edge, and
+    an overlap of at least OVERLAP_FRAC along the shared edge. Pairs are
+    ordered by i, then side (top, bottom, left, right), then j, the order in
+    which the greedy pass visits them. Returns (i, side index into SIDES, j).
+    """
+    g        = geometry or default_geometry()
+    near     = near_edge(table.boxes, g["width"], g["height"], EDGE_TOL)
+    n_labels = max(len(table.labels), 1)
+    found_i, found_side, found_j = [], [], []
+
+    for rank, side in enumerate(SIDES):
+        nb, has_nb = neighbor_stacks(table.stack, side, g)
+        src = np.flatnonzero(near[:, rank] & has_nb)
+        dst = np.flatnonzero(near[:, SIDES.index(OPPOSITE[side])])
+        # NEVER merge different taxa: join on (neighbour stack, label)
+        a, b = equal_key_pairs(nb[src] * n_labels + table.label[src],
+                               table.stack[dst] * n_labels + table.label[dst])
+        i, j = src[a], dst[b]
+
+        axis = "x" if side in ("top", "bottom") else "y"
+        keep = overlap_fraction(table.boxes[i], table.boxes[j], axis) >= OVERLAP_FRAC
+        found_i.append(i[keep])
+        found_j.append(j[keep])
+        found_side.append(np.full(int(keep.sum()), rank))
+
+    i, side, j = np.concatenate(found_i), np.concatenate(found_side), np.concatenate(found_j)
+    order = np.lexsort((j, side, i))
+    return i[order], side[order], j[order]
+
+def merge_duplicates(table, geometry=None, verify=None):
+    """
+    Greedy edge-duplicate removal over the candidate pairs in visiting order:
+    a pair is skipped once either box is gone, otherwise the lower confidence
+    one is removed. verify(table, i, side, j) may return a mask of the pairs
+    to keep as candidates (see image_check). Returns (kept mask, removed_log).
+    """
+    kept        = np.ones(len(table), dtype=bool)
+    removed_log = []
+
+    pairs = candidate_pairs(table, geometry)
+    if verify is not None:
+        confirmed = verify(table, *pairs)
+        pairs = tuple(a[confirmed] for a in pairs)
+
+    for i, _, j in zip(*pairs):
+        if not kept[i] or not kept[j]:
             continue
 
-        for other in by_stack.get(nb, []):
-
-            if id(det) not in kept or id(other) not in kept:
-                continue
-
-            # NEVER merge different taxa
-            if det["label"] != other["label"]:
-                continue
-
-            e1 = near_edge(det["bbox"])
-            e2 = near_edge(other["bbox"])
-
-            if side == "top"    and not (e1["top"]    and e2["bottom"]): continue
-            if side == "bottom" and not (e1["bottom"] and e2["top"]):    continue
-            if side == "left"   and not (e1["left"]   and e2["right"]):  continue
-            if side == "right"  and not (e1["right"]  and e2["left"]):   continue
-
-            axis = "x" if side in ("top", "bottom") else "y"
-            if overlap_fraction(det["bbox"], other["bbox"], axis) < OVERLAP_FRAC:
-                continue
-
-            # same grain → keep highest confidence
-            if det["confidence"] >= other["confidence"]:
-                kept.discard(id(other))
-                removed_log.append({
-                    "removed_stack": other["stack"],
-                    "kept_stack": det["stack"],
-                    "label": det["label"],
-                    "confidence_kept": det["confidence"]
-                })
-            else:
-                kept.discard(id(det))
-                removed_log.append({
-                    "removed_stack": det["stack"],
-                    "kept_stack": other["stack"],
-                    "label": other["label"],
-                    "confidence_kept": other["confidence"]
-                })
+        # same grain → keep highest confidence
+        winner, loser = (i, j) if table.confidence[i] >= table.confidence[j] else (j, i)
+        kept[loser] = False
+        removed_log.append({
+            "removed_stack": int(table.stack[loser]),
+            "kept_stack": int(table.stack[winner]),
+            "label": table.label_name(winner),
+            "confidence_kept": float(table.confidence[winner])
+        })
+
+    return kept, removed_log
 
 # ============================================================
-# SAVE UPDATED JSONS
+# IMAGE CHECK (optional)
 # ============================================================
-final_by_stack = defaultdict(list)
-
-for det in detections:
-    if id(det) in kept:
-        final_by_stack[det["stack"]].append(det)
-
-for path in json_files:
-    stack_id = int(os.path.basename(path).split("_")[1].split(".")[0])
-    with open(path) as f:
-        data = json.load(f)
+def stack_paths_for(docs, stack_dir):
+    """{stack id: stack path} for the JSONs of a folder, matched by file name."""
+    by_name = {p.stem: p for p in list_stacks(stack_dir)}
+    paths = {}
+    for path, stack_id, _ in docs:
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name in by_name:
+            paths.setdefault(stack_id, by_name[name])
+    return paths
+
+def middle_plane(path):
+    """Middle focal plane of a stack; memory-mapped where possible, otherwise only that page is decoded."""
+    if path.parent.suffix == ".zarr":
+        stack = open_stack(path)
+        return stack[stack.shape[0] // 2]
+    import tifffile
+    with tifffile.TiffFile(path) as tif:
+        middle = tif.series[0].shape[0] // 2  # stacks are (Z, Y, X[, C])
+    try:
+        return tifffile.memmap(path, mode="r")[middle]  # only this plane is read from disk
+    except ValueError:  # compressed or tiled pages
+        return tifffile.imread(path, key=middle)
+
+def seam_band(plane, side, depth):
+    """The `depth` rows/columns of a plane next to one border (image order), as gray float32."""
+    if side == "top":
+        band = plane[:depth]
+    elif side == "bottom":
+        band = plane[plane.shape[0]-depth:]
+    elif side == "left":
+        band = plane[:, :depth]
+    else:
+        band = plane[:, plane.shape[1]-depth:]
+    band = np.asarray(band, dtype=np.float32)
+    return band.mean(axis=2) if band.ndim == 3 else band
+
+def ncc(a, b):
+    """Normalized cross-correlation of two equally shaped arrays (nan if either is flat)."""
+    a = a - a.mean()
+    b = b - b.mean()
+    denom = math.sqrt(float((a * a).sum()) * float((b * b).sum()))
+    return float((a * b).sum()) / denom if denom > 1e-6 else float("nan")
+
+def image_check(table, i, side, j, stack_paths, geometry=None, min_ncc=MIN_NCC, strip_px=STRIP_PX):
+    """
+    Mask over candidate pairs (i, side, j): False where the strips at the
+    shared edge of the two stacks, cropped to the span of both boxes, do not
+    correlate (NCC < min_ncc). With a stage overlap the overlapping strips are
+    compared; without one the strip_px rows/columns on both sides of the seam,
+    mirrored. The middle plane of every involved stack is read once and only
+    the needed bands are kept.
+    """
+    g = geometry or default_geometry()
+    ox, oy = g.get("overlap") or (0, 0)
+
+    def overlap(s):
+        return oy if s in ("top", "bottom") else ox
+
+    needed = defaultdict(set)
+    for a, s, b in zip(i, side, j):
+        needed[int(table.stack[a])].add(SIDES[s])
+        needed[int(table.stack[b])].add(OPPOSITE[SIDES[s]])
+
+    bands = {}
+    for stack, sides in needed.items():
+        path = stack_paths.get(stack)
+        if path is None:
+            continue
+        plane = middle_plane(path)
+        for s in sides:
+            bands[(stack, s)] = seam_band(plane, s, int(overlap(s)) if overlap(s) > 0 else strip_px)
+
+    confirmed = np.ones(len(i), dtype=bool)
+    for k, (a, s, b) in enumerate(zip(i, side, j)):
+        s = SIDES[s]
+        band_a = bands.get((int(table.stack[a]), s))
+        band_b = bands.get((int(table.stack[b]), OPPOSITE[s]))
+        if band_a is None or band_b is None:
+            continue
 
-    data["shapes"] = [d["raw"] for d in final_by_stack.get(stack_id, [])]
+        # crop to the span of both boxes along the seam
+        along = 0 if s in ("top", "bottom") else 1
+        lo = max(int(min(table.boxes[a, along], table.boxes[b, along])), 0)
+        hi = int(math.ceil(max(table.boxes[a, along + 2], table.boxes[b, along + 2])))
+        if along == 0:  # horizontal seam, bands are (depth, width)
+            crop_a, crop_b = band_a[:, lo:hi], band_b[:, lo:hi]
+        else:           # vertical seam, bands are (height, depth)
+            crop_a, crop_b = band_a[lo:hi], band_b[lo:hi]
+        if overlap(s) <= 0:
+            crop_a = np.flip(crop_a, axis=along)  # no overlap: pair rows/columns by distance to the seam
+
+        if crop_a.size == 0 or crop_a.shape != crop_b.shape:
+            continue
+        if ncc(crop_a, crop_b) < min_ncc:  # nan (flat strip) is not judged
+            confirmed[k] = False
+    return confirmed
 
-    out = os.path.join(OUT_DIR, os.path.basename(path))
+# ============================================================
+# SAVE UPDATED JSONS
+# ============================================================
+def _copy_unchanged(src, dst, link=False):
+    """Copy an unchanged JSON into the output folder, or hard-link it with link=True (copy across file systems)."""
+    if os.path.exists(dst):
+        # a link left by an earlier LINK_UNCHANGED run is replaced by a copy
+        if os.path.samefile(src, dst) and (link or os.path.realpath(src) == os.path.realpath(dst)):
+            return
+        os.remove(dst)
+    if link:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+def _write_doc(job):
+    path, data, shapes, out, link = job
+    if shapes is None:
+        _copy_unchanged(path, out, link)
+        return False
+    data = dict(data, shapes=shapes)
+    if os.path.exists(out):
+        os.remove(out)  # never write through a hard link to the input
     with open(out, "w") as f:
         json.dump(data, f, indent=2)
+    return True
+
+def save_merged(docs, table, kept, out_dir, threads=WRITE_THREADS, link=LINK_UNCHANGED):
+    """
+    Write the kept shapes of every stack from the documents parsed at load.
+    Only JSONs whose shape list changed are rewritten; the others are
+    copied unchanged (hard-linked with link=True, see LINK_UNCHANGED).
+    Returns (rewritten, unchanged).
+    """
+    final_by_stack = defaultdict(list)
+
+    for i in np.flatnonzero(kept):
+        final_by_stack[int(table.stack[i])].append(table.raw[i])
+
+    jobs = []
+    for path, stack_id, data in docs:
+        shapes = final_by_stack.get(stack_id, [])
+        old    = data.get("shapes", [])
+        # shapes are the parsed objects themselves, so identity tells what survived
+        changed = len(shapes) != len(old) or any(a is not b for a, b in zip(shapes, old))
+        out = os.path.join(out_dir, os.path.basename(path))
+        jobs.append((path, data, shapes if changed or "shapes" not in data else None, out, link))
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        rewritten = sum(pool.map(_write_doc, jobs))
+    return rewritten, len(jobs) - rewritten
 
 # ============================================================
 # REPORT
 # ============================================================
-vertical   = sum(1 for r in removed_log if r["removed_stack"] - r["kept_stack"] in [-1,1] or r["removed_stack"] == r["kept_stack"])
-horizontal = len(removed_log) - vertical
-
-affected_stacks = sorted(
-    set(r["removed_stack"] for r in removed_log) |
-    set(r["kept_stack"] for r in removed_log)
-)
-
-print("\nMERGE SUMMARY")
-print("-" * 30)
-print(f"Total merges: {len(removed_log)}")
-print(f"Vertical merges   : {vertical}")
-print(f"Horizontal merges : {horizontal}")
-print(f"Stacks affected ({len(affected_stacks)}): {affected_stacks}")
-
-# optional: full merge log per stack without direction
-print("\nFULL MERGE LOG:")
-for r in removed_log:
-    print(r)
+def merge_counts(removed_log, geometry=None):
+    """(vertical merges, horizontal merges, affected stacks); vertical = both stacks in one grid column."""
+    vertical   = sum(1 for r in removed_log
+                     if stack_to_grid(r["removed_stack"], geometry)[1] == stack_to_grid(r["kept_stack"], geometry)[1])
+    horizontal = len(removed_log) - vertical
+
+    affected_stacks = sorted(
+        set(r["removed_stack"] for r in removed_log) |
+        set(r["kept_stack"] for r in removed_log)
+    )
+    return vertical, horizontal, affected_stacks
+
+def report(removed_log, geometry=None):
+    vertical, horizontal, affected_stacks = merge_counts(removed_log, geometry)
+
+    print("\nMERGE SUMMARY")
+    print("-" * 30)
+    print(f"Total merges: {len(removed_log)}")
+    print(f"Vertical merges   : {vertical}")
+    print(f"Horizontal merges : {horizontal}")
+    print(f"Stacks affected ({len(affected_stacks)}): {affected_stacks}")
+
+    # optional: full merge log per stack without direction
+    print("\nFULL MERGE LOG:")
+    for r in removed_log:
+        print(r)
+
+# ============================================================
+# BATCH MODE
+# ============================================================
+def discover_slides(json_root):
+    """
+    (slide name, JSON folder) pairs in the extract_pollen_stacks output layout:
+    json_root itself if it holds stack JSONs, else each subfolder that does.
+    """
+    if stack_json_files(json_root):
+        return [(os.path.basename(os.path.normpath(json_root)), json_root)]
+    slides = []
+    for name in sorted(os.listdir(json_root)):
+        folder = os.path.join(json_root, name)
+        if os.path.isdir(folder) and stack_json_files(folder):
+            slides.append((name, folder))
+    return slides
+
+def read_slide_sidecar(path):
+    """Geometry from a Create_multitif_stacks slide.json (grid, image size, stack positions)."""
+    with open(path) as f:
+        meta = json.load(f)
+    positions = {}
+    for name, (r, c) in meta.get("stacks", {}).items():
+        try:
+            positions[stack_id_of(name)] = (r, c)
+        except (IndexError, ValueError):
+            continue
+    return {
+        "rows": meta["grid"]["rows"],
+        "cols": meta["grid"]["cols"],
+        "order": meta["grid"].get("order", "column"),
+        "width": meta["image_width"],
+        "height": meta["image_height"],
+        "overlap": (meta.get("overlap_px", {}).get("x", 0), meta.get("overlap_px", {}).get("y", 0)),
+        "positions": positions or None,
+        "stack_at": {pos: stack for stack, pos in positions.items()},
+    }
+
+def slide_geometry(slide, json_dir, stack_root=STACK_ROOT):
+    """
+    Geometry of one slide: SLIDE_GEOMETRY entries first, then the slide.json
+    sidecar (JSON folder, <stack_root>/<slide>/<slide>_stacks or <stack_root>),
+    then the CONFIG values. Returns (geometry, source).
+    """
+    geometry, source = default_geometry(), "config"
+    sidecars = [os.path.join(json_dir, SLIDE_META_NAME)]
+    if stack_root:
+        sidecars += [os.path.join(stack_root, slide, f"{slide}_stacks", SLIDE_META_NAME),
+                     os.path.join(stack_root, SLIDE_META_NAME)]
+    for path in sidecars:
+        if os.path.exists(path):
+            geometry, source = read_slide_sidecar(path), path
+            break
+
+    override = SLIDE_GEOMETRY.get(slide)
+    if override:
+        geometry = dict(geometry, **override)
+        if {"rows", "cols", "order"} & set(override):
+            geometry["positions"] = None  # an explicit grid replaces the sidecar positions
+        source = "SLIDE_GEOMETRY"
+    return geometry, source
+
+def slide_stack_dir(slide, stack_root=STACK_ROOT):
+    """Stack folder of a slide for the image check (extract_pollen_stacks input layout), or None."""
+    if not stack_root:
+        return None
+    for folder in (os.path.join(stack_root, slide, f"{slide}_stacks"), stack_root):
+        if os.path.isdir(folder) and list_stacks(folder):
+            return folder
+    return None
+
+def merge_slide(job):
+    """Merge one slide folder into out_dir; runs in a worker process."""
+    slide, json_dir, out_dir, geometry, stack_dir = job
+    os.makedirs(out_dir, exist_ok=True)
+    docs, table = load_detections(json_dir, verbose=False)
+
+    rejected = []
+    verify = None
+    if stack_dir:
+        stack_paths = stack_paths_for(docs, stack_dir)
+
+        def verify(*pairs):
+            confirmed = image_check(*pairs, stack_paths=stack_paths, geometry=geometry)
+            rejected.append(int((~confirmed).sum()))
+            return confirmed
+
+    kept, removed_log = merge_duplicates(table, geometry, verify)
+    rewritten, unchanged = save_merged(docs, table, kept, out_dir)
+    vertical, horizontal, affected_stacks = merge_counts(removed_log, geometry)
+    return {
+        "slide": slide,
+        "files": len(docs),
+        "detections": len(table),
+        "merges": len(removed_log),
+        "vertical": vertical,
+        "horizontal": horizontal,
+        "stacks_affected": len(affected_stacks),
+        "rewritten": rewritten,
+        "rejected": sum(rejected),
+        "removed_log": removed_log,
+    }
+
+def merge_batch(json_root, out_root, stack_root=STACK_ROOT, n_processes=N_PROCESSES, report_csv=REPORT_CSV,
+                verify_images=VERIFY_IMAGES):
+    """
+    Merge every slide under json_root into out_root/<slide>; prints one combined
+    report. With verify_images the candidates are image-checked against the
+    slide's stacks under stack_root.
+    """
+    slides = discover_slides(json_root)
+    print(f"Slides found: {len(slides)}")
+
+    jobs = []
+    for slide, json_dir in slides:
+        geometry, source = slide_geometry(slide, json_dir, stack_root)
+        print(f"  {slide}: {geometry['rows']}x{geometry['cols']} grid, "
+              f"{geometry['width']}x{geometry['height']} px ({source})")
+        stack_dir = slide_stack_dir(slide, stack_root) if verify_images else None
+        if verify_images and stack_dir is None:
+            print(f"  {slide}: no stacks found under {stack_root}, image check skipped")
+        jobs.append((slide, json_dir, os.path.join(out_root, slide), geometry, stack_dir))
+
+    if n_processes > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_processes, len(jobs))) as pool:
+            results = list(pool.map(merge_slide, jobs))
+    else:
+        results = [merge_slide(job) for job in jobs]
+
+    batch_report(results)
+    if results and report_csv:
+        path = os.path.join(out_root, report_csv)
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["slide", "removed_stack", "kept_stack", "label", "confidence_kept"])
+            for res in results:
+                for r in res["removed_log"]:
+                    writer.writerow([res["slide"], r["removed_stack"], r["kept_stack"], r["label"], r["confidence_kept"]])
+        print(f"\nMerge log saved: {path}")
+    return results
+
+def batch_report(results):
+    print("\nBATCH MERGE SUMMARY")
+    header = (f"{'slide':30s} {'JSONs':>6s} {'detections':>10s} {'merges':>7s} {'vertical':>8s} "
+              f"{'horizontal':>10s} {'stacks':>7s} {'img-rejected':>12s}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['slide']:30s} {r['files']:6d} {r['detections']:10d} {r['merges']:7d} "
+              f"{r['vertical']:8d} {r['horizontal']:10d} {r['stacks_affected']:7d} {r['rejected']:12d}")
+    print("-" * len(header))
+    print(f"{'TOTAL':30s} {sum(r['files'] for r in results):6d} {sum(r['detections'] for r in results):10d} "
+          f"{sum(r['merges'] for r in results):7d} {sum(r['vertical'] for r in results):8d} "
+          f"{sum(r['horizontal'] for r in results):10d} {sum(r['stacks_affected'] for r in results):7d} "
+          f"{sum(r['rejected'] for r in results):12d}")
+
+    labels = Counter(m["label"] for r in results for m in r["removed_log"])
+    if labels:
+        print("\nMerges per label:")
+        for label, count in labels.most_common():
+            print(f"  {label:18s} {count}")
+
+
+if __name__ == "__main__":
+    if BATCH:
+        merge_batch(JSON_ROOT, OUT_ROOT)
+    else:
+        os.makedirs(OUT_DIR, exist_ok=True)
+        docs, table = load_detections(JSON_DIR)
+        verify = None
+        if VERIFY_IMAGES:
+            stack_paths = stack_paths_for(docs, STACK_DIR)
+            print(f"Image check: {len(stack_paths)} stacks found in {STACK_DIR}")
+
+            def verify(*pairs):
+                confirmed = image_check(*pairs, stack_paths=stack_paths)
+                print(f"Image check: {int((~confirmed).sum())} of {len(confirmed)} candidate pairs rejected")
+                return confirmed
+
+        kept, removed_log = merge_duplicates(table, verify=verify)
+        rewritten, unchanged = save_merged(docs, table, kept, OUT_DIR)
+        print(f"JSONs rewritten: {rewritten}, unchanged ({'linked' if LINK_UNCHANGED else 'copied'}): {unchanged}")
+        report(removed_log)
@@ -6,19 +6,29 @@
 import os
 import cv2
 import json
+import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
-import tifffile
+
+from Create_multitif_stacks import (EDF_SUBFOLDER, FOCUS_METRICS_NAME, list_stacks, open_stack,
+                                    read_focus_metrics)
 
 # ===== CONFIG =====
-tiff_folder = r"YOUR_TIFF_IMAGE_FOLDER"
+tiff_folder = r"YOUR_TIFF_IMAGE_FOLDER"  # TIFF/OME-TIFF stacks or a stacks.zarr store
 json_folder = r"YOUR_JSON_FOLDER"
+show_edf = False  # show the extended-depth-of-field composite (stacks/edf, Create_multitif_stacks --edf) if present
 
 # ===== FILE LISTS =====
-tiff_files = sorted([f for f in os.listdir(tiff_folder) if f.lower().endswith((".tif", ".tiff"))])
+tiff_files = [p.name for p in list_stacks(tiff_folder)]
 json_files = sorted([f for f in os.listdir(json_folder) if f.lower().endswith(".json")])
 json_dict = {os.path.splitext(f)[0]: f for f in json_files}
 
+# Create_multitif_stacks sidecars (focus_metrics.csv, edf/) live next to the stacks;
+# the best-focus plane of each stack is shown if focus metrics are present
+focus_folder = os.path.dirname(tiff_folder.rstrip("/\\")) if tiff_folder.endswith(".zarr") else tiff_folder
+focus_path = os.path.join(focus_folder, FOCUS_METRICS_NAME)
+focus = read_focus_metrics(focus_path) if os.path.exists(focus_path) else {}
+
 # ===== STATE =====
 index = 0
 total = len(tiff_files)
@@ -32,21 +42,24 @@ def load_image(idx):
     fname = tiff_files[idx]
     base = os.path.splitext(fname)[0]
     path = os.path.join(tiff_folder, fname)
-    img_stack = tifffile.imread(path)
+    edf_path = os.path.join(focus_folder, EDF_SUBFOLDER, base + ".tif")
+    if show_edf and os.path.exists(edf_path):
+        path = edf_path  # single all-in-focus plane
+    img_stack = open_stack(path)  # memory-mapped/chunked: only the shown plane is read
 
     # Handle 4D/3D arrays
     if img_stack.ndim == 4:  # multi-page RGB
-        middle_index = img_stack.shape[0] // 2
-        img = img_stack[middle_index]
+        middle_index = focus[base]["best_plane"] if base in focus else img_stack.shape[0] // 2
+        img = np.asarray(img_stack[middle_index])
     elif img_stack.ndim == 3:
         if img_stack.shape[2] in [3,4]:  # single RGB
-            img = img_stack
+            img = np.asarray(img_stack)
         else:  # grayscale stack
-            middle_index = img_stack.shape[0] // 2
-            img = img_stack[middle_index]
+            middle_index = focus[base]["best_plane"] if base in focus else img_stack.shape[0] // 2
+            img = np.asarray(img_stack[middle_index])
             img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
     else:  # single grayscale
-        img = cv2.cvtColor(img_stack, cv2.COLOR_GRAY2RGB)
+        img = cv2.cvtColor(np.asarray(img_stack), cv2.COLOR_GRAY2RGB)
     return img, base
 
 # ===== DISPLAY =====
@@ -0,0 +1,123 @@
+"""
+Script to relabel detections from the float16 class-score sidecar written by
+Tofsi_Detection.py (save_scores = True), without rerunning the model.
+Applies per-class confidence thresholds and reassigns boxes below their
+threshold to the low-confidence class ("Ind"). Writes LabelMe JSONs with the
+new labels/confidences and prints per-class totals before and after, plus
+the top-k alternatives of the reassigned boxes.
+
+Assumes the JSONs still hold the detector's shapes in their original order
+(e.g. before edge merging), since shapes are matched to score rows by position.
+"""
+
+import json
+import os
+from collections import Counter
+
+import numpy as np
+
+from Tofsi_Detection import SCORES_INDEX_NAME, SCORES_META_NAME, SCORES_NAME
+
+# ============================================================
+# CONFIG
+# ============================================================
+JSON_DIR = r"YOUR_DETECTION_JSON_FOLDER"   # detection output with the sidecar
+OUT_DIR  = r"RESCORED_JSON_OUTPUT"
+
+DEFAULT_THRESHOLD = 0.0                    # applies to classes not listed below
+CLASS_THRESHOLDS  = {}                     # e.g. {"Poa": 0.6, "Quercus": 0.5}
+LOWCONF_LABEL     = "Ind"                  # label for boxes below their threshold
+TOP_K             = 3                      # alternatives reported per reassigned box
+
+# ============================================================
+# SIDECAR ACCESS
+# ============================================================
+def load_scores(json_dir):
+    """
+    Memory-map a folder's score sidecar.
+    Returns (scores (N, n_classes) float16, {stack: (start, count)}, class names or None).
+    """
+    with open(os.path.join(json_dir, SCORES_META_NAME)) as f:
+        meta = json.load(f)
+    index = {}
+    with open(os.path.join(json_dir, SCORES_INDEX_NAME)) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                index[record["stack"]] = (record["start"], record["count"])  # last record wins
+
+    path = os.path.join(json_dir, SCORES_NAME)
+    n_rows = os.path.getsize(path) // (2 * meta["n_classes"])
+    if n_rows == 0:
+        scores = np.zeros((0, meta["n_classes"]), dtype=meta["dtype"])
+    else:
+        scores = np.memmap(path, dtype=meta["dtype"], mode="r", shape=(n_rows, meta["n_classes"]))
+    return scores, index, meta["classes"]
+
+# ============================================================
+# VECTORIZED RELABELLING
+# ============================================================
+def relabel(scores, classes, default_threshold=DEFAULT_THRESHOLD,
+            class_thresholds=CLASS_THRESHOLDS, lowconf_label=LOWCONF_LABEL):
+    """Argmax label per row, replaced by lowconf_label where the score misses its class threshold."""
+    names = np.asarray(list(classes) + [lowconf_label], dtype=object)
+    thresholds = np.array([class_thresholds.get(c, default_threshold) for c in classes],
+                          dtype=np.float32)
+    best = scores.argmax(axis=1)
+    confidence = scores.max(axis=1).astype(np.float32)
+    best = np.where(confidence >= thresholds[best], best, len(classes))
+    return names[best], confidence
+
+def top_k(scores, k=TOP_K):
+    """Indices and scores of the k best classes per row, best first."""
+    k = min(k, scores.shape[1])
+    idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    vals = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-vals, axis=1)
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(vals, order, axis=1)
+
+# ============================================================
+# MAIN
+# ============================================================
+if __name__ == "__main__":
+    os.makedirs(OUT_DIR, exist_ok=True)
+    scores, index, classes = load_scores(JSON_DIR)
+    if classes is None:
+        raise SystemExit("Sidecar has no class names (class list did not match the score width).")
+    print(f"Score matrix: {scores.shape[0]} boxes x {scores.shape[1]} classes")
+
+    labels, confidence = relabel(np.asarray(scores, dtype=np.float32), classes)
+
+    before, after = Counter(), Counter()
+    mismatched = 0
+    for stack, (start, count) in index.items():
+        path = os.path.join(JSON_DIR, stack + ".json")
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            data = json.load(f)
+        shapes = data.get("shapes", [])
+        if len(shapes) != count:
+            mismatched += 1
+            continue
+        for i, shape in enumerate(shapes, start=start):
+            before[shape["label"]] += 1
+            shape["label"] = str(labels[i])
+            shape["confidence"] = float(confidence[i])
+            after[shape["label"]] += 1
+        with open(os.path.join(OUT_DIR, stack + ".json"), "w") as f:
+            json.dump(data, f, indent=2)
+
+    print("\nPER-CLASS TOTALS (before -> after)")
+    for label in sorted(set(before) | set(after)):
+        print(f"  {label:12s} {before[label]:6d} -> {after[label]:6d}")
+    if mismatched:
+        print(f"\nSkipped {mismatched} stack(s) whose JSON shape count no longer matches the sidecar.")
+
+    reassigned = np.flatnonzero(labels == LOWCONF_LABEL)
+    if len(reassigned):
+        idx, vals = top_k(np.asarray(scores[reassigned], dtype=np.float32))
+        print(f"\nTop-{idx.shape[1]} alternatives of the first reassigned boxes:")
+        for row, (ci, cv) in zip(reassigned[:20], zip(idx[:20], vals[:20])):
+            alternatives = ", ".join(f"{classes[c]} {v:.2f}" for c, v in zip(ci, cv))
+            print(f"  box {row}: {alternatives}")
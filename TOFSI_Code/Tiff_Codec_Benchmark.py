@@ -0,0 +1,243 @@
+"""
+Benchmark of TIFF storage settings for the multitiff stacks.
+Re-writes a sample of existing stacks with every codec/level, strip or tiled
+layout and predictor option the way Create_multitif_stacks.py writes them,
+and measures encode and decode time, bytes on disk, the pixel error of lossy
+codecs and (optionally) how well detections on the re-encoded stack agree
+with detections on the original.
+Prints a comparison table and writes it as CSV.
+
+Codecs other than none/zlib need the imagecodecs package; settings
+that cannot be written are listed as unavailable.
+
+How to use in Spyder:
+1) Edit the CONFIG block (STACK_FOLDER, etc.)
+2) Run.
+
+CLI:
+    python Tiff_Codec_Benchmark.py /path/to/stacks --sample 5 --detect --model /path/to/model.zip
+"""
+
+# =========================
+# ======== CONFIG =========
+STACK_FOLDER = r"YOUR_STACK_FOLDER"
+N_SAMPLE = 5  # stacks benchmarked (evenly spread over the folder)
+OUTPUT_CSV = r"codec_benchmark.csv"
+
+# (codec, level) pairs; level None = codec default, for jpeg the level is the quality
+CODECS = [
+    ("none", None),
+    ("packbits", None),
+    ("lzw", None),
+    ("zlib", 1),
+    ("zlib", 6),
+    ("zlib", 9),
+    ("jpeg", 95),
+    ("jpeg", 85),
+    ("jpeg2000", None),
+]
+LAYOUTS = ["strip", "tile"]
+TILE = (256, 256)
+PREDICTORS = [False, True]  # horizontal differencing, only tried with lossless deflate-type codecs
+PREDICTOR_CODECS = ("zlib", "lzw")
+
+DETECT = False  # compare detections with the uncompressed stack (slow)
+MODEL = None  # model zip for DETECT (default: pthModel in Tofsi_Detection.py)
+IOU_MATCH = 0.5  # boxes with the same label and at least this IoU count as agreeing
+# ======== CONFIG =========
+# =========================
+
+import csv
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import tifffile as tf
+
+from Create_multitif_stacks import natural_key, save_stack
+from Detection_Table import iou_matrix
+
+
+def sample_stacks(folder, n):
+    """n stack paths spread evenly over the natural-sorted folder."""
+    stacks = sorted((p for p in Path(folder).iterdir() if p.suffix.lower() in (".tif", ".tiff")),
+                    key=lambda p: natural_key(p.name))
+    if len(stacks) <= n:
+        return stacks
+    return [stacks[i] for i in np.linspace(0, len(stacks) - 1, n).round().astype(int)]
+
+
+def settings(codecs=CODECS, layouts=LAYOUTS, predictors=PREDICTORS):
+    """All (codec, level, layout, predictor) combinations worth trying."""
+    combos = []
+    for codec, level in codecs:
+        for layout in layouts:
+            for predictor in predictors:
+                if predictor and codec not in PREDICTOR_CODECS:
+                    continue
+                combos.append((codec, level, layout, predictor))
+    return combos
+
+
+def _write_options(codec, level, layout, predictor):
+    """save_stack() arguments for one setting."""
+    options = {}
+    if level is not None:
+        options["compressionargs"] = {"level": level}
+    if layout == "tile":
+        options["tile"] = TILE
+    if predictor:
+        options["predictor"] = True
+    return (None if codec == "none" else codec), options
+
+
+def box_agreement(ref, test, iou_match=IOU_MATCH):
+    """
+    Fraction of boxes that agree between two detection results: each
+    reference box is matched to the best unused test box with the same label
+    and IoU >= iou_match; matches / max(#ref, #test) (1.0 if both are empty).
+    """
+    a = np.asarray(ref["boxes"], dtype=float).reshape(-1, 4)
+    b = np.asarray(test["boxes"], dtype=float).reshape(-1, 4)
+    if len(a) == 0 and len(b) == 0:
+        return 1.0
+    if len(a) == 0 or len(b) == 0:
+        return 0.0
+    iou = iou_matrix(a, b)
+    same_label = np.asarray(ref["labels"])[:, None] == np.asarray(test["labels"])[None, :]
+    iou = np.where(same_label, iou, 0.0)
+
+    matched = 0
+    used = np.zeros(len(b), dtype=bool)
+    for row in iou:
+        row = np.where(used, 0.0, row)
+        j = int(row.argmax())
+        if row[j] >= iou_match:
+            used[j] = True
+            matched += 1
+    return matched / max(len(a), len(b))
+
+
+def benchmark(stacks, combos, detector=None):
+    """
+    Re-encode every stack with every setting. Returns one row per setting with
+    totals over the sample (MB on disk, seconds) and the worst pixel error /
+    mean detection agreement. detector, if given, runs the model on a stack
+    file (the original and each re-encoded file).
+    """
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        originals = [(p, tf.imread(p)) for p in stacks]
+        reference = [detector(p) for p, _ in originals] if detector else None
+        raw_mb = sum(data.nbytes for _, data in originals) / 2**20
+
+        for codec, level, layout, predictor in combos:
+            compression, options = _write_options(codec, level, layout, predictor)
+            row = {"codec": codec, "level": "" if level is None else level, "layout": layout,
+                   "predictor": predictor, "raw_mb": round(raw_mb, 2)}
+            size = encode_s = decode_s = 0.0
+            max_err = 0
+            agreement = []
+            try:
+                for i, (path, data) in enumerate(originals):
+                    out = Path(tmp) / path.name
+                    t0 = time.perf_counter()
+                    save_stack(data, out, compression, **options)
+                    encode_s += time.perf_counter() - t0
+                    size += os.path.getsize(out)
+
+                    t0 = time.perf_counter()
+                    decoded = tf.imread(out)
+                    decode_s += time.perf_counter() - t0
+                    diff = np.abs(decoded.astype(np.int64) - data.astype(np.int64))
+                    max_err = max(max_err, int(diff.max()) if diff.size else 0)
+                    if detector:
+                        agreement.append(box_agreement(reference[i], detector(out)))
+                    out.unlink()
+            except Exception as e:
+                row["error"] = f"{type(e).__name__}: {e}"
+                rows.append(row)
+                continue
+
+            row.update({
+                "disk_mb": round(size / 2**20, 2),
+                "ratio": round(raw_mb * 2**20 / max(size, 1), 2),
+                "encode_mb_s": round(raw_mb / max(encode_s, 1e-9), 1),
+                "decode_mb_s": round(raw_mb / max(decode_s, 1e-9), 1),
+                "max_abs_err": max_err,
+                "agreement": round(float(np.mean(agreement)), 3) if agreement else "",
+                "error": "",
+            })
+            rows.append(row)
+    return rows
+
+
+def print_table(rows):
+    """Print the benchmark rows, best compression ratio first."""
+    header = (f"{'codec':9s} {'level':>5s} {'layout':6s} {'pred':4s} {'MB':>9s} {'ratio':>6s} "
+              f"{'enc MB/s':>9s} {'dec MB/s':>9s} {'maxerr':>6s} {'agree':>6s}")
+    print(header)
+    print("-" * len(header))
+    ok = sorted((r for r in rows if not r.get("error")), key=lambda r: -r["ratio"])
+    for r in ok:
+        print(f"{r['codec']:9s} {str(r['level']):>5s} {r['layout']:6s} {'yes' if r['predictor'] else 'no':4s} "
+              f"{r['disk_mb']:9.2f} {r['ratio']:6.2f} {r['encode_mb_s']:9.1f} {r['decode_mb_s']:9.1f} "
+              f"{r['max_abs_err']:6d} {str(r['agreement']):>6s}")
+    failed = [r for r in rows if r.get("error")]
+    if failed:
+        print("\nUnavailable settings:")
+        for r in failed:
+            print(f"  {r['codec']} {r['level']} {r['layout']} predictor={r['predictor']}: {r['error']}")
+
+
+def write_csv(rows, path):
+    fields = ["codec", "level", "layout", "predictor", "raw_mb", "disk_mb", "ratio",
+              "encode_mb_s", "decode_mb_s", "max_abs_err", "agreement", "error"]
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields, restval="")
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _detector(model_path):
+    """Return a function running the TOFSI model on a stack file (the model decodes it itself)."""
+    import Tofsi_Detection as td
+    td.load_model(model_path or td.pthModel)
+    return td.detect_stack
+
+
+def run(folder, n_sample=N_SAMPLE, output_csv=OUTPUT_CSV, detect=DETECT, model=MODEL):
+    stacks = sample_stacks(folder, n_sample)
+    if not stacks:
+        print(f"No stacks found in {folder}", file=sys.stderr)
+        return []
+    print(f"Benchmarking {len(stacks)} stack(s) from {folder}")
+    rows = benchmark(stacks, settings(), _detector(model) if detect else None)
+    print_table(rows)
+    write_csv(rows, output_csv)
+    print(f"\nSaved: {output_csv}")
+    return rows
+
+
+def _parse_args(argv):
+    """Parse CLI arguments."""
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark TIFF codecs and layouts on multitiff stacks.")
+    parser.add_argument("folder", help="Folder with stack TIFFs.")
+    parser.add_argument("--sample", type=int, default=N_SAMPLE, help=f"Stacks to use (default: {N_SAMPLE}).")
+    parser.add_argument("--csv", default=OUTPUT_CSV, help=f"Output table (default: {OUTPUT_CSV}).")
+    parser.add_argument("--detect", action="store_true",
+                        help="Also measure detection agreement with the uncompressed stacks.")
+    parser.add_argument("--model", default=MODEL, help="Model zip for --detect.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        a = _parse_args(sys.argv[1:])
+        run(a.folder, a.sample, a.csv, a.detect, a.model)
+    else:
+        run(STACK_FOLDER)
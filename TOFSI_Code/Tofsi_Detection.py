@@ -2,6 +2,13 @@
 Detection script for the TOFSI model.
 Slightly altered from the original given by Theuerkauf et al. (2023).
 Pollen image output is disabled but can be reactivated if necessary.
+
+Batched inference (several stacks per forward pass) is not feasible with the
+packaged model: its interface is the per-image process_image(); the detector
+and classifier it wraps are internal to the package, so stacks go through the
+model one at a time. Throughput comes from decoding ahead of the model (prefetch_workers),
+worker processes (n_processes) and skipping work (incremental, prescreen);
+progress reports stacks per second.
 """
 
 ###############################################################################
@@ -11,21 +18,48 @@ Pollen image output is disabled but can be reactivated if necessary.
 root_directory = r"MULTITIFF PATH"
 output_directory = r"DETECTION OUTPUT"
 pthModel = r"USED MODEL"
+# Stacks go through the per-image process_image() one at a time; there is no batch
+# size because the packaged model cannot batch (see above). With prefetch_workers > 0
+# decoding overlaps the model and the decoded arrays are handed to process_image;
+# if the model rejects arrays (TypeError) it reads the stack files itself and the
+# prefetcher stops decoding.
+prefetch_workers = 0  # threads decoding upcoming stacks while the model runs (0 = off)
+prefetch_max_mb = 2048  # memory cap for decoded stacks waiting in the prefetch queue
+n_processes = 1  # worker processes sharing the stacks of all folders (1 = single process)
+torch_threads = 0  # torch threads per worker process (0 = CPU cores // n_processes)
+incremental = False  # only (re)detect stacks that are new, changed or from another model
+output_format = "labelme"  # "labelme" (JSON per stack) or "jsonl" (one compact file per folder)
+save_scores = False  # also keep every box's full class-score vector in a float16 sidecar
+prescreen_threshold = 0.0  # skip stacks whose middle-plane focus statistic is below this (0 = off)
+prescreen_step = 4  # downsampling stride of the middle plane for the prescreen statistic
+timing_log = False  # per-stack stage timings to timings.jsonl plus a summary table per folder
+profile_every = 0  # cProfile every Nth stack into <output>/profiles (0 = off)
+profile_torch = False  # also capture a torch profiler table for the profiled stacks
+cache_directory = r"~/.cache/tofsi"  # remembered model hashes and class lists
 
 ###############################################################################
 ### imports and setup
 ###############################################################################
 
-import torch
 import warnings
 warnings.simplefilter('ignore')
 import json
 import os
+import hashlib
 import zipfile
-import shutil
+import numpy as np
 import tifffile as tf
 from glob import glob
 import sys
+import csv
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import multiprocessing
+from itertools import islice
+import cProfile
+import statistics
+from Create_multitif_stacks import FOCUS_METRICS_NAME, read_focus_metrics
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
@@ -33,43 +67,99 @@ os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 ### load model
 ###############################################################################
 
-model = torch.package.PackageImporter(pthModel).load_pickle(
-    'model', 'model.pkl', map_location=torch.device('cpu')
-)
+# Loaded on demand and kept per model hash, so worker processes importing this
+# module do not unpickle it twice and repeated detect() calls in one Python
+# session (or the detection service) reuse the warm model.
+model = None
+model_path = None
+taxalist = ()
+_loaded_models = {}
+
+def _lazy_imports():
+    """Import torch only when a model is actually loaded or run."""
+    global torch
+    import torch
+    return torch
+
+def _file_hash(path, chunk_size=1 << 20):
+    """SHA-256 of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def get_model_hash(pth=pthModel):
+    """
+    SHA-256 of the model file. Hashes are remembered in the cache directory
+    by path, size and mtime, so the file is only re-read when it changes.
+    """
+    st = os.stat(pth)
+    key = f"{os.path.abspath(pth)}|{st.st_size}|{st.st_mtime_ns}"
+    fnIndex = os.path.join(os.path.expanduser(cache_directory), "model_hashes.json")
+    try:
+        with open(fnIndex) as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        index = {}
+
+    if key not in index:
+        index[key] = _file_hash(pth)
+        os.makedirs(os.path.dirname(fnIndex), exist_ok=True)
+        fnTmp = f"{fnIndex}.{os.getpid()}.tmp"
+        with open(fnTmp, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(fnTmp, fnIndex)
+    return index[key]
+
+def load_model(pth=pthModel):
+    """Load the torch.package model into the module-level `model` (cached per model hash)."""
+    global model, model_path
+    key = get_model_hash(pth)
+    if key not in _loaded_models:
+        _lazy_imports()
+        _loaded_models[key] = torch.package.PackageImporter(pth).load_pickle(
+            'model', 'model.pkl', map_location=torch.device('cpu')
+        )
+    model, model_path = _loaded_models[key], pth
+    return model
 
 ###############################################################################
-### extract class list
+### read class list
 ###############################################################################
 
-destination_path = os.path.dirname(pthModel)
-file_to_extract = 'class_list.txt'
-subdirectory = os.path.splitext(os.path.basename(pthModel))[0] + '/' + 'model'
+def read_class_list(pth=pthModel):
+    """
+    Read class_list.txt straight from the model zip into `taxalist`, without
+    writing temporary files. The list is cached per model hash.
+    """
+    global taxalist
+    fnCache = os.path.join(os.path.expanduser(cache_directory), get_model_hash(pth), 'class_list.txt')
+    if os.path.exists(fnCache):
+        with open(fnCache, 'r') as file:
+            taxalist = tuple(file.read().splitlines())
+        return taxalist
+
+    file_to_extract = 'class_list.txt'
+    subdirectory = os.path.splitext(os.path.basename(pth))[0] + '/' + 'model'
 
-with zipfile.ZipFile(pthModel, 'r') as zip_ref:
-    file_list = zip_ref.namelist()
-    subdirectory_exists = any(file.startswith(f"{subdirectory}/") for file in file_list)
-    
-    if subdirectory_exists:
+    with zipfile.ZipFile(pth, 'r') as zip_ref:
+        file_list = zip_ref.namelist()
         file_to_extract_path = f"{subdirectory}/{file_to_extract}"
-        if file_to_extract_path in file_list:
-            extracted_file_path = zip_ref.extract(file_to_extract_path)
-            destination_file_path = os.path.join(destination_path, file_to_extract)
-            shutil.copy(extracted_file_path, destination_file_path)
-            os.remove(extracted_file_path)
-        else:
+        if file_to_extract_path not in file_list:
+            # torch.package keeps the archive name the model was saved under
+            file_to_extract_path = next(
+                (file for file in file_list if file.endswith(f"/model/{file_to_extract}")), None)
+        if file_to_extract_path is None:
             print('class file missing')
-    else:
-        print('class file missing')
+            return taxalist
+        text = zip_ref.read(file_to_extract_path).decode('utf-8')
 
-# read classes
-file_path = os.path.join(destination_path, file_to_extract)
-try:
-    with open(file_path, "r") as file:
-        taxalist = tuple(file.read().splitlines())
-except FileNotFoundError:
-    print(f"The file '{file_path}' does not exist.")
-except Exception as e:
-    print(f"An error occurred {e}")
+    os.makedirs(os.path.dirname(fnCache), exist_ok=True)
+    with open(fnCache, 'w') as file:
+        file.write(text)
+    taxalist = tuple(text.splitlines())
+    return taxalist
 
 ###############################################################################
 ### JSON template
@@ -107,38 +197,766 @@ def result_to_json(result):
     }, indent=2)
 
 ###############################################################################
-### detection function (JSON OUTPUT ONLY)
+### compact output (one JSON-lines file per folder)
 ###############################################################################
 
-def detect(pthSample, pthJSON):
-    """Run detection on all TIFFs in a folder and save JSONs only."""
-    os.makedirs(pthJSON, exist_ok=True)
-    img_list = glob(os.path.join(pthSample, "*.tif"))
-    n = len(img_list)
+# One line per stack with boxes, labels and the full cls_scores matrix.
+# Detections_To_Labelme.py converts it back to per-stack LabelMe JSON.
+# Incremental reruns append; readers keep the last record of each stack.
+COMPACT_NAME = "detections.jsonl"
+
+def _compact_lines(done):
+    """(JSON folder, line) records for finished (stack, JSON path, result) triples."""
+    lines = []
+    for img, fnJSON, result in done:
+        record = {
+            "stack": os.path.splitext(os.path.basename(img))[0],
+            "boxes": result['boxes'].tolist(),
+            "labels": [str(label) for label in result['labels']],
+            "cls_scores": result['cls_scores'].tolist(),
+        }
+        lines.append((os.path.dirname(fnJSON), json.dumps(record) + "\n"))
+    return lines
+
+def _append_compact(lines):
+    """Append records to each folder's compact file (one open per folder and call)."""
+    by_folder = {}
+    for pthJSON, line in lines:
+        by_folder.setdefault(pthJSON, []).append(line)
+    for pthJSON, folder_lines in by_folder.items():
+        with open(os.path.join(pthJSON, COMPACT_NAME), 'a') as f:
+            f.write(''.join(folder_lines))
 
-    for i, img in enumerate(img_list):
-        result = model.process_image(img)
-        fnImg = os.path.basename(img)
-        fnBase = os.path.splitext(fnImg)[0]
-        fnJSON = os.path.join(pthJSON, fnBase + '.json')
+def _compact_stacks(pthJSON):
+    """Names of the stacks that have a record in a folder's compact file."""
+    try:
+        with open(os.path.join(pthJSON, COMPACT_NAME)) as f:
+            return {json.loads(line)["stack"] for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
 
+###############################################################################
+### class-score sidecar (float16, memory-mappable)
+###############################################################################
+
+# cls_scores.f16 holds the rows of every box's score vector back to back
+# (little-endian float16, n_classes columns); cls_scores_index.jsonl maps each
+# stack to its first row and box count, in the same order as its JSON shapes.
+# Rescore_Detections.py memory-maps the matrix to relabel without re-inference.
+SCORES_NAME = "cls_scores.f16"
+SCORES_INDEX_NAME = "cls_scores_index.jsonl"
+SCORES_META_NAME = "cls_scores_meta.json"
+
+def _append_scores(done):
+    """Append the score rows and index records of finished stacks, per folder."""
+    by_folder = {}
+    for img, fnJSON, result in done:
+        by_folder.setdefault(os.path.dirname(fnJSON), []).append((img, result['cls_scores']))
+
+    for pthJSON, items in by_folder.items():
+        fnMeta = os.path.join(pthJSON, SCORES_META_NAME)
+        if os.path.exists(fnMeta):
+            with open(fnMeta) as f:
+                n_classes = json.load(f)["n_classes"]
+        else:
+            n_classes = next((scores.shape[1] for _, scores in items if len(scores)), None)
+        if n_classes is not None and not os.path.exists(fnMeta):
+            with open(fnMeta, 'w') as f:
+                json.dump({
+                    "dtype": "<f2",
+                    "n_classes": n_classes,
+                    # column names, if the class list matches the score width
+                    "classes": list(taxalist) if len(taxalist) == n_classes else None,
+                }, f, indent=2)
+
+        records = []
+        with open(os.path.join(pthJSON, SCORES_NAME), 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            row = f.tell() // (2 * n_classes) if n_classes else 0
+            for img, scores in items:
+                f.write(np.ascontiguousarray(scores, dtype='<f2').tobytes())
+                stack = os.path.splitext(os.path.basename(img))[0]
+                records.append(json.dumps({"stack": stack, "start": row, "count": len(scores)}) + "\n")
+                row += len(scores)
+        with open(os.path.join(pthJSON, SCORES_INDEX_NAME), 'a') as f:
+            f.write(''.join(records))
+
+def _scored_stacks(pthJSON):
+    """Names of the stacks that have rows in a folder's score index."""
+    try:
+        with open(os.path.join(pthJSON, SCORES_INDEX_NAME)) as f:
+            return {json.loads(line)["stack"] for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+def _reset_outputs(pthJSON):
+    """Remove appended per-folder outputs so a full rerun starts fresh files."""
+    for name in (COMPACT_NAME, SCORES_NAME, SCORES_INDEX_NAME, SCORES_META_NAME, TIMINGS_NAME,
+                 PRESCREEN_REPORT_NAME):
+        if os.path.exists(os.path.join(pthJSON, name)):
+            os.remove(os.path.join(pthJSON, name))
+
+###############################################################################
+### writing results
+###############################################################################
+
+def _write_results(done, output_format=output_format, save_scores=save_scores):
+    """Write finished (stack, JSON path, result) triples in the chosen output format."""
+    if save_scores:
+        _append_scores(done)
+    if output_format == "jsonl":
+        _append_compact(_compact_lines(done))
+        return
+    for img, fnJSON, result in done:
         with open(fnJSON, 'w') as f:
             f.write(result_to_json(result))
 
-        op = f"detecting progress: {round(100 * i / n, 1)}%"
+def _output_file(fnJSON, output_format):
+    """File that holds a stack's detections in the given output format."""
+    if output_format == "jsonl":
+        return os.path.join(os.path.dirname(fnJSON), COMPACT_NAME)
+    return fnJSON
+
+###############################################################################
+### instrumentation (stage timings, memory, profiling)
+###############################################################################
+
+TIMINGS_NAME = "timings.jsonl"
+TIMING_STAGES = ("read_s", "wait_s", "model_s", "write_s")
+
+def _peak_rss_mb():
+    """Peak resident memory of this process in MB (None where unavailable)."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / 2**20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+def _profile_path(img, fnJSON):
+    """Base path for the profiler output of a sampled stack."""
+    pthProfiles = os.path.join(os.path.dirname(fnJSON), "profiles")
+    os.makedirs(pthProfiles, exist_ok=True)
+    return os.path.join(pthProfiles, os.path.splitext(os.path.basename(img))[0])
+
+def _profiled(fnProfile, fn, *args):
+    """Call fn under cProfile (and the torch profiler if enabled) and save the results."""
+    profiler = cProfile.Profile()
+    if profile_torch:
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU]) as tprof:
+            result = profiler.runcall(fn, *args)
+        with open(fnProfile + "_torch.txt", 'w') as f:
+            f.write(tprof.key_averages().table(sort_by="cpu_time_total", row_limit=40))
+    else:
+        result = profiler.runcall(fn, *args)
+    profiler.dump_stats(fnProfile + ".prof")
+    return result
+
+def _append_timings(records):
+    """Append per-stack timing records to each folder's timings.jsonl."""
+    by_folder = {}
+    for record in records:
+        by_folder.setdefault(record["folder"], []).append(json.dumps(record) + "\n")
+    for pthJSON, lines in by_folder.items():
+        with open(os.path.join(pthJSON, TIMINGS_NAME), 'a') as f:
+            f.write(''.join(lines))
+
+def _print_timing_summary(records, elapsed):
+    """Per-stage mean / median / p95 / total seconds, throughput and peak memory."""
+    if not records:
+        return
+    print(f"\n{'stage':<10}{'mean':>10}{'median':>10}{'p95':>10}{'total':>10}")
+    for stage in TIMING_STAGES:
+        values = sorted(r[stage] for r in records if r[stage] is not None)
+        if not values:
+            continue
+        p95 = values[min(len(values) - 1, int(0.95 * len(values)))]
+        print(f"{stage[:-2]:<10}{statistics.mean(values):>10.3f}{statistics.median(values):>10.3f}"
+              f"{p95:>10.3f}{sum(values):>10.1f}")
+    peaks = [r["peak_rss_mb"] for r in records if r["peak_rss_mb"] is not None]
+    print(f"{len(records)} stacks, {len(records) / max(elapsed, 1e-9):.2f} stacks/s"
+          + (f", peak RSS {max(peaks):.0f} MB" if peaks else ""))
+
+###############################################################################
+### detection function (JSON OUTPUT ONLY)
+###############################################################################
+
+def _stack_nbytes(path):
+    """Decoded size of a TIFF stack in bytes, read from its header only."""
+    with tf.TiffFile(path) as tif:
+        series = tif.series[0]
+        return series.size * series.dtype.itemsize
+
+def _timed_imread(img):
+    """Decode a stack and return it with the seconds it took."""
+    t0 = time.perf_counter()
+    stack = tf.imread(img)
+    return stack, time.perf_counter() - t0
+
+def _prefetch_stacks(img_list, n_workers, max_bytes):
+    """
+    Decode stacks in a thread pool ahead of the model and yield
+    (path, array, decode seconds) in input order. The queue depth is derived from the header size of the
+    first stack so decoded stacks waiting in the queue stay under max_bytes
+    (at least one stack is always in flight). Once the model has rejected
+    arrays, queued decodes are cancelled and the remaining stacks are yielded
+    as paths for the model to read.
+    """
+    if not img_list:
+        return
+    depth = max(1, min(2 * n_workers, max_bytes // max(_stack_nbytes(img_list[0]), 1)))
+    upcoming = iter(img_list)
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        queue = deque((img, pool.submit(_timed_imread, img)) for img in islice(upcoming, depth))
+        while queue:
+            if _array_input is False:
+                for _, future in queue:
+                    future.cancel()
+                for img in [img for img, _ in queue] + list(upcoming):
+                    yield img, img, None
+                return
+            img, future = queue.popleft()
+            stack, read_s = future.result()
+            nxt = next(upcoming, None)
+            if nxt is not None:
+                queue.append((nxt, pool.submit(_timed_imread, nxt)))
+            yield img, stack, read_s
+
+_array_input = None  # does model.process_image accept decoded arrays? (checked on first use)
+ARRAY_INPUT_ERROR = ("process_image() of this model does not accept decoded arrays, so stacks that "
+                     "only exist in memory cannot be detected; write the stacks and run detect() on them")
+
+def _run_model(img, stack, from_file=True):
+    """
+    process_image() on a stack path, or on a decoded array if the model takes
+    arrays. The first array call checks that: if it raises a TypeError and
+    the model can read the same stack from its file, the model reads the
+    stack files from then on. Arrays that were not decoded from a file
+    (from_file=False) never fall back to the path; a rejected array raises a
+    TypeError with ARRAY_INPUT_ERROR. Other errors are raised as they are.
+    """
+    global _array_input
+    if isinstance(stack, str) or _array_input:
+        return model.process_image(stack)
+    if _array_input is False:
+        if not from_file:
+            raise TypeError(ARRAY_INPUT_ERROR)
+        return model.process_image(img)
+    try:
+        result = model.process_image(stack)
+    except TypeError as e:
+        if not from_file:
+            raise TypeError(f"{ARRAY_INPUT_ERROR} ({e})") from e
+        result = model.process_image(img)  # raises if the stack itself is the problem
+        print(f"\n[WARN] process_image does not take decoded arrays ({e}); "
+              "the model reads the stack files instead.")
+        _array_input = False
+        return result
+    _array_input = True
+    return result
+
+def _process_stack(img, stack, fnProfile=None, from_file=True):
+    """
+    Run the model on one stack (path or decoded array, see _run_model); under
+    the profilers if fnProfile is set. Returns the result and the model seconds.
+    """
+    t0 = time.perf_counter()
+    if fnProfile is None:
+        result = _run_model(img, stack, from_file)
+    else:
+        result = _profiled(fnProfile, _run_model, img, stack, from_file)
+    return result, time.perf_counter() - t0
+
+def _folder_jobs(pthSample, pthJSON):
+    """List (stack path, JSON path) pairs for all TIFFs in a folder (or a list of TIFFs)."""
+    if isinstance(pthSample, (list, tuple)):
+        img_list = list(pthSample)
+    else:
+        img_list = glob(os.path.join(pthSample, "*.tif"))
+    jobs = []
+    for img in img_list:
+        fnBase = os.path.splitext(os.path.basename(img))[0]
+        jobs.append((img, os.path.join(pthJSON, fnBase + '.json')))
+    return jobs
+
+def _run_jobs(jobs, prefetch_workers, on_stack=None, write=_write_results,
+              timings=None, source=None, first_index=0):
+    """
+    Detect every (stack, JSON) job, pass the (stack, JSON path, result)
+    triple of each stack to write() and then call on_stack(done_jobs).
+    If `timings` is a list, a per-stack stage timing record is appended to it.
+    `source` may supply the (stack, array, read seconds) triples directly
+    instead of decoding the stack files; those arrays are never replaced by
+    the stack file if the model rejects them. first_index is the position of the
+    first job in the whole run (for a shard), so profile_every samples every
+    Nth stack overall.
+    """
+    img_list = [img for img, _ in jobs]
+    json_for = dict(jobs)
+    from_file = source is None
+
+    if source is None:
+        if prefetch_workers > 0 and _array_input is not False:
+            source = _prefetch_stacks(img_list, prefetch_workers, prefetch_max_mb * 2**20)
+        else:
+            source = ((img, img, None) for img in img_list)  # model reads the file itself
+
+    n_started = first_index
+    t_wait = time.perf_counter()
+    for img, stack, read_s in source:
+        wait_s = time.perf_counter() - t_wait
+        sampled = profile_every > 0 and n_started % profile_every == 0
+        n_started += 1
+
+        result, model_s = _process_stack(img, stack, _profile_path(img, json_for[img]) if sampled else None,
+                                         from_file)
+        del stack  # do not hold the decoded stack while the next one is waited for
+        t_write = time.perf_counter()
+        write([(img, json_for[img], result)])
+        write_s = time.perf_counter() - t_write
+
+        if timings is not None:
+            timings.append({
+                "stack": os.path.basename(img),
+                "folder": os.path.dirname(json_for[img]),
+                "read_s": read_s,
+                "wait_s": wait_s,
+                "model_s": model_s,
+                "write_s": write_s,
+                "boxes": len(result['boxes']),
+                "peak_rss_mb": _peak_rss_mb(),
+            })
+
+        if on_stack is not None:
+            on_stack([(img, json_for[img])])
+        t_wait = time.perf_counter()
+
+def _progress_printer(n):
+    """Return a callback that prints overall progress and throughput for n stacks."""
+    t_start = time.perf_counter()
+    done = 0
+
+    def on_stack(k):
+        nonlocal done
+        done += k
+        rate = done / max(time.perf_counter() - t_start, 1e-9)
+        op = f"detecting progress: {round(100 * done / n, 1)}% ({rate:.2f} stacks/s)"
         sys.stdout.write("\r" + op)
         sys.stdout.flush()
 
-    print("\nDetection finished!")
+    def finish():
+        elapsed = time.perf_counter() - t_start
+        print(f"\nDetection finished! {n} stacks in {elapsed:.1f} s "
+              f"({n / max(elapsed, 1e-9):.2f} stacks/s)")
+        return elapsed
+
+    return on_stack, finish
+
+###############################################################################
+### run manifest (incremental mode)
+###############################################################################
+
+MANIFEST_NAME = "detection_manifest.json"
+
+def _load_manifest(pthJSON):
+    """Read the run manifest of an output folder (empty if there is none)."""
+    try:
+        with open(os.path.join(pthJSON, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"stacks": {}}
+
+def _save_manifest(pthJSON, manifest):
+    """Write the manifest atomically so a crash never leaves it half written."""
+    fnManifest = os.path.join(pthJSON, MANIFEST_NAME)
+    with open(fnManifest + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(fnManifest + '.tmp', fnManifest)
+
+def _manifest_entry(img, model_hash, prescreen_threshold=None):
+    """
+    Manifest record for a stack whose JSON was just written; stacks skipped
+    by the prescreen also keep the threshold they were skipped at.
+    """
+    st = os.stat(img)
+    entry = {
+        "path": os.path.abspath(img),
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "sha256": _file_hash(img),
+        "model_hash": model_hash,
+    }
+    if prescreen_threshold is not None:
+        entry["prescreen_threshold"] = prescreen_threshold
+    return entry
+
+def _plan_jobs(jobs, manifest, model_hash, output_format=output_format, save_scores=save_scores,
+               prescreen_threshold=prescreen_threshold):
+    """
+    Drop jobs whose JSON is up to date for this model. A stack is unchanged
+    when size and mtime match its manifest entry or, failing that, when its
+    content hash still does. In jsonl mode a stack without a record in the
+    folder's detections.jsonl, and with save_scores a stack without rows in
+    the score sidecar (e.g. detected before scores were enabled), counts as
+    output missing. Stacks skipped by the prescreen are recorded with their
+    threshold and are screened again when it changes. Returns the remaining
+    jobs and a reason count.
+    """
+    compact = {}  # output folder -> stacks in its detections.jsonl
+    scored = {}  # output folder -> stacks in its score index
+    todo = []
+    reasons = {"up to date": 0, "new": 0, "changed": 0, "model changed": 0,
+               "prescreen changed": 0, "output missing": 0}
+    for img, fnJSON in jobs:
+        pthJSON = os.path.dirname(fnJSON)
+        stack = os.path.splitext(os.path.basename(img))[0]
+        if output_format == "jsonl" and pthJSON not in compact:
+            compact[pthJSON] = _compact_stacks(pthJSON)
+        if save_scores and pthJSON not in scored:
+            scored[pthJSON] = _scored_stacks(pthJSON)
+        entry = manifest["stacks"].get(os.path.basename(img))
+        if entry is None:
+            reason = "new"
+        elif entry["model_hash"] != model_hash:
+            reason = "model changed"
+        elif "prescreen_threshold" in entry and entry["prescreen_threshold"] != prescreen_threshold:
+            reason = "prescreen changed"
+        elif not os.path.exists(_output_file(fnJSON, output_format)):
+            reason = "output missing"
+        elif output_format == "jsonl" and stack not in compact[pthJSON]:
+            reason = "output missing"
+        elif save_scores and stack not in scored[pthJSON]:
+            reason = "output missing"
+        else:
+            st = os.stat(img)
+            if (st.st_size, st.st_mtime_ns) == (entry["size"], entry["mtime_ns"]):
+                reason = "up to date"
+            elif _file_hash(img) == entry["sha256"]:
+                entry["size"], entry["mtime_ns"] = st.st_size, st.st_mtime_ns
+                reason = "up to date"
+            else:
+                reason = "changed"
+        reasons[reason] += 1
+        if reason != "up to date":
+            todo.append((img, fnJSON))
+    return todo, reasons
+
+def _print_plan(reasons):
+    """Print how many stacks were skipped or queued, by reason."""
+    print("incremental: " + ", ".join(f"{k} {v}" for k, v in reasons.items()))
+
+###############################################################################
+### prescreening of empty / out-of-focus stacks
+###############################################################################
+
+PRESCREEN_REPORT_NAME = "prescreen_report.csv"
+
+def focus_statistic(plane, step=prescreen_step):
+    """Variance of the 4-neighbour Laplacian of a downsampled grayscale plane."""
+    g = plane[::step, ::step]
+    if g.ndim == 3:
+        g = g[..., :3].mean(axis=-1)
+    g = g.astype(np.float32)
+    lap = g[1:-1, :-2] + g[1:-1, 2:] + g[:-2, 1:-1] + g[2:, 1:-1] - 4 * g[1:-1, 1:-1]
+    return float(lap.var())
+
+def _middle_plane_statistic(img):
+    """Focus statistic of a stack's middle page; only that page is decoded."""
+    with tf.TiffFile(img) as tif:
+        return focus_statistic(tif.pages[len(tif.pages) // 2].asarray())
+
+_focus_sidecars = {}  # focus_metrics.csv path -> (mtime, focus metrics)
+
+def _sidecar_statistic(img):
+    """
+    Middle-plane focus statistic from the stack folder's focus_metrics.csv
+    (written by Create_multitif_stacks.py), or None if it has no matching entry.
+    """
+    fnMetrics = os.path.join(os.path.dirname(os.path.abspath(img)), FOCUS_METRICS_NAME)
+    try:
+        mtime = os.stat(fnMetrics).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if _focus_sidecars.get(fnMetrics, (None,))[0] != mtime:
+        _focus_sidecars[fnMetrics] = (mtime, read_focus_metrics(fnMetrics))
+    entry = _focus_sidecars[fnMetrics][1].get(os.path.splitext(os.path.basename(img))[0])
+    if entry is None or entry["step"] != prescreen_step:
+        return None
+    return entry["laplacian_var"][len(entry["laplacian_var"]) // 2]
+
+def _empty_result():
+    """Detector-shaped result with no boxes, written for skipped stacks."""
+    return {
+        'boxes': np.zeros((0, 4), dtype=np.float32),
+        'labels': [],
+        'cls_scores': np.zeros((0, max(len(taxalist), 1)), dtype=np.float32),
+    }
+
+def _prescreen_jobs(jobs, threshold, n_threads=8):
+    """
+    Compute the middle-plane focus statistic of every stack in a thread pool
+    and split jobs into (kept, skipped). The statistic of each screened stack
+    is merged into the prescreen_report.csv of its output folder (one row
+    per stack), so incremental and watch-mode runs keep the earlier rows.
+    """
+    stats = [_sidecar_statistic(img) for img, _ in jobs]
+    todo = [i for i, stat in enumerate(stats) if stat is None]
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        for i, stat in zip(todo, pool.map(_middle_plane_statistic, [jobs[i][0] for i in todo])):
+            stats[i] = stat
+
+    kept, skipped, rows = [], [], {}
+    for (img, fnJSON), stat in zip(jobs, stats):
+        skip = stat < threshold
+        (skipped if skip else kept).append((img, fnJSON))
+        rows.setdefault(os.path.dirname(fnJSON), []).append(
+            [os.path.basename(img), f"{stat:.3f}", int(skip)])
+
+    for pthJSON, folder_rows in rows.items():
+        fnReport = os.path.join(pthJSON, PRESCREEN_REPORT_NAME)
+        report = {}
+        if os.path.exists(fnReport):
+            with open(fnReport, newline='') as f:
+                report = {row[0]: row for row in islice(csv.reader(f), 1, None) if row}
+        report.update((row[0], row) for row in folder_rows)
+        with open(fnReport + '.tmp', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["stack", "focus_statistic", "skipped"])
+            writer.writerows(report.values())
+        os.replace(fnReport + '.tmp', fnReport)
+    print(f"prescreen: skipped {len(skipped)} of {len(jobs)} stacks "
+          f"(focus statistic < {threshold})")
+    return kept, skipped
+
+###############################################################################
+### detection entry point
+###############################################################################
+
+def detect_stack(img):
+    """
+    Run the model on one stack file and return its raw result (boxes, labels,
+    cls_scores) without writing anything, e.g. for comparisons across encodings.
+    """
+    if model is None:
+        load_model()
+    return model.process_image(str(img))
+
+def detect(pthSample, pthJSON, prefetch_workers=prefetch_workers,
+           incremental=incremental, output_format=output_format, save_scores=save_scores,
+           prescreen_threshold=prescreen_threshold, timing_log=timing_log, on_done=None):
+    """
+    Run detection on all TIFFs in a folder (or an explicit list of TIFF paths)
+    and save JSONs only.
+    Stacks go through the model one at a time. With prefetch_workers > 0
+    upcoming stacks are decoded in background threads while the model
+    processes the current one. With incremental=True only stacks that are missing from or
+    out of date in the folder's run manifest are detected. output_format
+    "jsonl" streams all stacks into one compact detections.jsonl instead of
+    writing a LabelMe JSON per stack. save_scores=True also appends every
+    box's full score vector to the folder's float16 sidecar. Stacks whose
+    middle-plane focus statistic is below prescreen_threshold are not run
+    through the model and get an empty result. timing_log=True records
+    per-stack read / queue wait / model / write seconds and peak memory in
+    timings.jsonl and prints a summary table.
+    on_done(done_jobs, n_jobs) is called with the finished (stack, JSON) pairs
+    after every stack, e.g. to stream progress from the detection service.
+    """
+    if model is None:
+        load_model()
+    if save_scores and not taxalist:
+        read_class_list(model_path)
+    os.makedirs(pthJSON, exist_ok=True)
+    jobs = _folder_jobs(pthSample, pthJSON)
+
+    if incremental:
+        model_hash = get_model_hash(model_path)
+        manifest = _load_manifest(pthJSON)
+        jobs, reasons = _plan_jobs(jobs, manifest, model_hash, output_format, save_scores,
+                                   prescreen_threshold)
+        _save_manifest(pthJSON, manifest)
+        _print_plan(reasons)
+    else:
+        _reset_outputs(pthJSON)
+    if prescreen_threshold > 0:
+        jobs, skipped = _prescreen_jobs(jobs, prescreen_threshold)
+        _write_results([(img, fnJSON, _empty_result()) for img, fnJSON in skipped],
+                       output_format, save_scores)
+        if incremental:
+            for img, _ in skipped:
+                manifest["stacks"][os.path.basename(img)] = _manifest_entry(img, model_hash, prescreen_threshold)
+            _save_manifest(pthJSON, manifest)
+    progress, finish = _progress_printer(len(jobs))
+
+    def on_stack(done_jobs):
+        if incremental:
+            for img, _ in done_jobs:
+                manifest["stacks"][os.path.basename(img)] = _manifest_entry(img, model_hash)
+            _save_manifest(pthJSON, manifest)
+        progress(len(done_jobs))
+        if on_done is not None:
+            on_done(done_jobs, len(jobs))
+
+    timings = [] if timing_log else None
+    _run_jobs(jobs, prefetch_workers, on_stack,
+              write=lambda done: _write_results(done, output_format, save_scores),
+              timings=timings)
+    elapsed = finish()
+    if timing_log:
+        _append_timings(timings)
+        _print_timing_summary(timings, elapsed)
+
+def detect_arrays(jobs, source, pthJSON, output_format=output_format,
+                  save_scores=save_scores, timing_log=timing_log):
+    """
+    Run detection on stacks that are already in memory, e.g. assembled from the
+    focal planes by Create_multitif_stacks.run_fused(), so no TIFF is decoded.
+    `jobs` are the (stack path, JSON path) pairs (the stack file does not need
+    to exist) and `source` yields (stack path, array, seconds spent producing
+    it) in the same order; stacks missing from the source are left out.
+    Outputs are handled as in a non-incremental detect() run. The model must
+    accept decoded arrays; otherwise the first stack raises a TypeError
+    (ARRAY_INPUT_ERROR) and nothing is read back from the stack files.
+    """
+    if model is None:
+        load_model()
+    if _array_input is False:
+        raise TypeError(ARRAY_INPUT_ERROR)
+    if save_scores and not taxalist:
+        read_class_list(model_path)
+    os.makedirs(pthJSON, exist_ok=True)
+    _reset_outputs(pthJSON)
+    progress, finish = _progress_printer(len(jobs))
+
+    timings = [] if timing_log else None
+    _run_jobs(jobs, 0, lambda done_jobs: progress(len(done_jobs)),
+              write=lambda done: _write_results(done, output_format, save_scores),
+              timings=timings, source=source)
+    elapsed = finish()
+    if timing_log:
+        _append_timings(timings)
+        _print_timing_summary(timings, elapsed)
+
+###############################################################################
+### multi-process detection
+###############################################################################
+
+def _init_worker(pth, n_threads):
+    """Pool initializer: pin the torch thread count and load the model once."""
+    _lazy_imports()
+    torch.set_num_threads(n_threads)
+    load_model(pth)
+
+def _detect_shard(jobs, prefetch_workers, model_hash=None, timing_log=False, first_index=0):
+    """
+    Worker entry point: detect one shard of jobs and return the finished
+    (stack, JSON path, result) triples plus their manifest entries (None
+    unless running incrementally) and timing records. The parent process
+    writes all output, so per-folder files only ever have a single writer.
+    """
+    done = []
+    timings = [] if timing_log else None
+    _run_jobs(jobs, prefetch_workers, write=done.extend, timings=timings, first_index=first_index)
+    done_jobs = [(img, fnJSON,
+                  {key: result[key] for key in ('boxes', 'labels', 'cls_scores')},
+                  _manifest_entry(img, model_hash) if model_hash else None)
+                 for img, fnJSON, result in done]
+    return done_jobs, timings
+
+def detect_parallel(jobs, n_processes=n_processes, pth=pthModel,
+                    prefetch_workers=prefetch_workers, incremental=incremental,
+                    output_format=output_format, save_scores=save_scores,
+                    prescreen_threshold=prescreen_threshold, timing_log=timing_log):
+    """
+    Shard (stack, JSON) jobs, possibly from several folders, across a pool of
+    worker processes. Each worker loads the model once and runs with
+    `torch_threads` torch threads; the parent process writes the results and
+    merges progress, run manifests and timing records (write time is
+    measured in the parent).
+    """
+    if save_scores and not taxalist:
+        read_class_list(pth)
+    model_hash = None
+    manifests = {}
+    folders = {os.path.dirname(fnJSON) for _, fnJSON in jobs}
+    if incremental:
+        model_hash = get_model_hash(pth)
+        todo = []
+        reasons = {}
+        for pthJSON in folders:
+            manifests[pthJSON] = _load_manifest(pthJSON)
+            folder_todo, folder_reasons = _plan_jobs(
+                [job for job in jobs if os.path.dirname(job[1]) == pthJSON],
+                manifests[pthJSON], model_hash, output_format, save_scores, prescreen_threshold)
+            todo += folder_todo
+            for k, v in folder_reasons.items():
+                reasons[k] = reasons.get(k, 0) + v
+            _save_manifest(pthJSON, manifests[pthJSON])
+        jobs = todo
+        _print_plan(reasons)
+    else:
+        for pthJSON in folders:
+            _reset_outputs(pthJSON)
+    if prescreen_threshold > 0:
+        jobs, skipped = _prescreen_jobs(jobs, prescreen_threshold)
+        _write_results([(img, fnJSON, _empty_result()) for img, fnJSON in skipped],
+                       output_format, save_scores)
+        if incremental:
+            for img, fnJSON in skipped:
+                manifests[os.path.dirname(fnJSON)]["stacks"][os.path.basename(img)] = \
+                    _manifest_entry(img, model_hash, prescreen_threshold)
+            for pthJSON in {os.path.dirname(fnJSON) for _, fnJSON in skipped}:
+                _save_manifest(pthJSON, manifests[pthJSON])
+
+    n_threads = torch_threads or max(1, (os.cpu_count() or 1) // n_processes)
+    shard_size = 8
+    shards = [(i, jobs[i:i + shard_size]) for i in range(0, len(jobs), shard_size)]
+
+    progress, finish = _progress_printer(len(jobs))
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=n_processes, mp_context=ctx,
+                             initializer=_init_worker, initargs=(pth, n_threads)) as pool:
+        futures = [pool.submit(_detect_shard, shard, prefetch_workers,
+                               model_hash, timing_log, first_index)
+                   for first_index, shard in shards]
+        all_timings = []
+        for future in as_completed(futures):
+            done_jobs, timings = future.result()
+            t_write = time.perf_counter()
+            _write_results([job[:3] for job in done_jobs], output_format, save_scores)
+            if timing_log:
+                write_s = (time.perf_counter() - t_write) / max(len(done_jobs), 1)
+                for record in timings:
+                    record["write_s"] = write_s
+                _append_timings(timings)
+                all_timings += timings
+            if incremental:
+                touched = set()
+                for img, fnJSON, _, entry in done_jobs:
+                    pthJSON = os.path.dirname(fnJSON)
+                    manifests[pthJSON]["stacks"][os.path.basename(img)] = entry
+                    touched.add(pthJSON)
+                for pthJSON in touched:
+                    _save_manifest(pthJSON, manifests[pthJSON])
+            progress(len(done_jobs))
+    elapsed = finish()
+    if timing_log:
+        for pthJSON in sorted(folders):
+            print(f"\nTimings for {pthJSON}:")
+            _print_timing_summary([r for r in all_timings if r["folder"] == pthJSON], elapsed)
 
 ###############################################################################
 ### full extraction and cropping (DISABLED – JSON ONLY)
 ###############################################################################
 
-def extract_pollen_stacks(root_dir, output_dir):
+def extract_pollen_stacks(root_dir, output_dir, n_processes=n_processes):
     """
     Detect pollen and save JSONs only.
     Cropping and TIFF writing are intentionally disabled.
+    With n_processes > 1 the stacks of all folders are sharded across workers.
     """
     folders_to_process = []
 
@@ -155,6 +973,17 @@ def extract_pollen_stacks(root_dir, output_dir):
                 if os.path.exists(stacks_folder_path) and os.path.isdir(stacks_folder_path):
                     folders_to_process.append((stacks_folder_path, folder_name))
 
+    if n_processes > 1:
+        jobs = []
+        for stack_folder, folder_output_name in folders_to_process:
+            output_folder_path = os.path.join(output_dir, folder_output_name)
+            os.makedirs(output_folder_path, exist_ok=True)
+            jobs += _folder_jobs(stack_folder, output_folder_path)
+        print(f"Detecting pollen in {len(folders_to_process)} folder(s) "
+              f"with {n_processes} processes")
+        detect_parallel(jobs, n_processes)
+        return
+
     for stack_folder, folder_output_name in folders_to_process:
         output_folder_path = os.path.join(output_dir, folder_output_name)
         os.makedirs(output_folder_path, exist_ok=True)
@@ -211,6 +1040,7 @@ def extract_pollen_stacks(root_dir, output_dir):
 ###############################################################################
 
 if __name__ == "__main__":
+    read_class_list()
     os.makedirs(output_directory, exist_ok=True)
     extract_pollen_stacks(root_directory, output_directory)
     print("\nAll stacks processed successfully (JSON only).")
@@ -0,0 +1,255 @@
+"""
+Resident detection service for the TOFSI model.
+Loads the model and class list once, then runs detection jobs submitted over
+HTTP on localhost with the detect() logic from Tofsi_Detection.py.
+Jobs are a folder of stacks or a list of stack paths and run one at a time in
+submission order; per-stack completion is streamed back as JSON lines.
+
+Server:
+    python Tofsi_Service.py serve
+Client (waits until the job is done):
+    python Tofsi_Service.py submit STACK_FOLDER JSON_OUTPUT_FOLDER
+    python Tofsi_Service.py submit --stacks a.tif b.tif --output JSON_OUTPUT_FOLDER
+"""
+
+###############################################################################
+### inputs
+###############################################################################
+
+HOST = "127.0.0.1"  # localhost only, the service has no authentication
+PORT = 8765
+
+###############################################################################
+### imports and setup
+###############################################################################
+
+import json
+import os
+import queue
+import sys
+import threading
+import traceback
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+###############################################################################
+### job queue
+###############################################################################
+
+class Job:
+    """A detection request and the events it has produced so far."""
+
+    def __init__(self, job_id, stacks, output, incremental):
+        self.id = job_id
+        self.stacks = stacks      # folder path or list of stack paths
+        self.output = output
+        self.incremental = incremental
+        self.events = []
+        self.finished = False
+        self.cond = threading.Condition()
+
+    def emit(self, event, finished=False):
+        with self.cond:
+            self.events.append(event)
+            self.finished = self.finished or finished
+            self.cond.notify_all()
+
+    def status(self):
+        with self.cond:
+            return {"id": self.id, "finished": self.finished,
+                    "last_event": self.events[-1] if self.events else None}
+
+
+jobs = {}
+job_queue = queue.Queue()
+_job_lock = threading.Lock()
+
+
+def submit_job(stacks, output, incremental=False):
+    """Queue a job and return it."""
+    with _job_lock:
+        job = Job(len(jobs) + 1, stacks, output, incremental)
+        jobs[job.id] = job
+    job.emit({"event": "queued", "position": job_queue.qsize() + 1})
+    job_queue.put(job)
+    return job
+
+
+def _worker(td):
+    """Run queued jobs one after another on the warm model."""
+    while True:
+        job = job_queue.get()
+        job.emit({"event": "started"})
+        done = 0
+
+        def on_done(done_jobs, n_jobs):
+            nonlocal done
+            for img, fnJSON in done_jobs:
+                done += 1
+                job.emit({"event": "stack", "stack": img, "json": fnJSON,
+                          "done": done, "total": n_jobs})
+
+        try:
+            td.detect(job.stacks, job.output, incremental=job.incremental, on_done=on_done)
+            job.emit({"event": "finished", "done": done}, finished=True)
+        except Exception as e:
+            traceback.print_exc()
+            job.emit({"event": "failed", "error": f"{type(e).__name__}: {e}"}, finished=True)
+
+###############################################################################
+### HTTP interface
+###############################################################################
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    POST /jobs              {"folder" | "stacks", "output", "incremental"?} -> {"id"}
+    GET  /jobs/<id>         job status
+    GET  /jobs/<id>/events  all events of the job as JSON lines, streamed until it ends
+    """
+
+    def _send_json(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _job(self, parts):
+        try:
+            return jobs.get(int(parts[1]))
+        except (IndexError, ValueError):
+            return None
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self._send_json(404, {"error": "unknown endpoint"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            stacks = request["stacks"] if "stacks" in request else request["folder"]
+            output = request["output"]
+        except (ValueError, KeyError) as e:
+            return self._send_json(400, {"error": f"bad request: {e}"})
+        if isinstance(stacks, list):
+            missing = [p for p in stacks if not os.path.isfile(p)]
+        else:
+            missing = [] if os.path.isdir(stacks) else [stacks]
+        if missing:
+            return self._send_json(400, {"error": f"not found: {missing}"})
+        job = submit_job(stacks, output, bool(request.get("incremental", False)))
+        self._send_json(200, {"id": job.id})
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        job = self._job(parts) if parts[0] == "jobs" else None
+        if job is None:
+            return self._send_json(404, {"error": "unknown job"})
+        if len(parts) == 2:
+            return self._send_json(200, job.status())
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        sent = 0
+        while True:
+            with job.cond:
+                job.cond.wait_for(lambda: len(job.events) > sent or job.finished)
+                new_events = job.events[sent:]
+                finished = job.finished
+            for event in new_events:
+                self.wfile.write((json.dumps(event) + "\n").encode())
+            self.wfile.flush()
+            sent += len(new_events)
+            if finished and sent == len(job.events):
+                return
+
+    def log_message(self, format, *args):
+        pass  # keep the console for detection progress
+
+
+def serve(host=HOST, port=PORT, pth=None):
+    """Load the model once and serve detection jobs until interrupted."""
+    import Tofsi_Detection as td
+    pth = pth or td.pthModel
+    td.load_model(pth)
+    td.read_class_list(pth)
+    threading.Thread(target=_worker, args=(td,), daemon=True).start()
+    server = ThreadingHTTPServer((host, port), _Handler)
+    print(f"TOFSI detection service listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nService stopped.")
+
+###############################################################################
+### client
+###############################################################################
+
+def submit(stacks, output, incremental=False, host=HOST, port=PORT):
+    """Submit a job to a running service and print its progress until it ends."""
+    request = {"output": os.path.abspath(output), "incremental": incremental}
+    if isinstance(stacks, (list, tuple)):
+        request["stacks"] = [os.path.abspath(p) for p in stacks]
+    else:
+        request["folder"] = os.path.abspath(stacks)
+
+    url = f"http://{host}:{port}/jobs"
+    post = urllib.request.Request(url, data=json.dumps(request).encode(),
+                                  headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(post) as response:
+            job_id = json.load(response)["id"]
+    except urllib.error.HTTPError as e:
+        print(f"Job rejected: {json.load(e).get('error')}", file=sys.stderr)
+        return False
+    print(f"Submitted job {job_id}")
+
+    with urllib.request.urlopen(f"{url}/{job_id}/events") as stream:
+        for line in stream:
+            event = json.loads(line)
+            if event["event"] == "stack":
+                sys.stdout.write(f"\rjob {job_id}: {event['done']}/{event['total']} stacks")
+                sys.stdout.flush()
+            elif event["event"] == "finished":
+                print(f"\nJob {job_id} finished ({event['done']} stacks detected).")
+                return True
+            elif event["event"] == "failed":
+                print(f"\nJob {job_id} failed: {event['error']}", file=sys.stderr)
+                return False
+            else:
+                print(f"job {job_id}: {event['event']}")
+    return False
+
+
+def _parse_args(argv):
+    """Parse CLI arguments."""
+    import argparse
+    parser = argparse.ArgumentParser(description="Resident TOFSI detection service.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    sub = parser.add_subparsers(dest="command", required=True)
+    server = sub.add_parser("serve", help="Load the model and serve detection jobs.")
+    server.add_argument("--model", help="Model zip (default: pthModel in Tofsi_Detection.py).")
+    client = sub.add_parser("submit", help="Submit a job and wait for it.")
+    client.add_argument("folder", nargs="?", help="Folder of stack TIFFs.")
+    client.add_argument("output", nargs="?", help="Folder for the JSON output.")
+    client.add_argument("--stacks", nargs="+", help="Explicit stack TIFFs instead of a folder.")
+    client.add_argument("--output", dest="output_dir", help="Output folder when using --stacks.")
+    client.add_argument("--incremental", action="store_true",
+                        help="Skip stacks whose JSON is up to date (run manifest).")
+    args = parser.parse_args(argv)
+    if args.command == "submit":
+        args.output = args.output_dir or args.output
+        if not (args.stacks or args.folder) or not args.output:
+            parser.error("submit needs a stack folder (or --stacks) and an output folder")
+    return args
+
+
+if __name__ == "__main__":
+    a = _parse_args(sys.argv[1:])
+    if a.command == "serve":
+        serve(a.host, a.port, a.model)
+    else:
+        ok = submit(a.stacks or a.folder, a.output, a.incremental, a.host, a.port)
+        sys.exit(0 if ok else 1)